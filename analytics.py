@@ -0,0 +1,129 @@
+"""Статистика простых диапазона, собираемая за тот же проход, что и подсчет
+
+Кроме количества: число пар простых-близнецов (p, p+2), двоюродных
+(p, p+4) и «сексуальных» (p, p+6), наибольший промежуток между соседними
+простыми и его начало, первое и последнее простое. Статистики соседних
+участков склеиваются: пары и промежуток через границу восстанавливаются
+по простым у краев участков.
+"""
+from collections import deque
+
+# Расстояния между простыми в парах
+PAIR_GAPS = {'twin': 2, 'cousin': 4, 'sexy': 6}
+# Ширина края участка, простые которого нужны для склейки пар
+EDGE = max(PAIR_GAPS.values())
+
+
+class RangeStats:
+    """Статистика простых отрезка [start, end]; простые добавляются по возрастанию"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.pairs = dict.fromkeys(PAIR_GAPS, 0)
+        self.max_gap = 0
+        self.max_gap_start = None
+        # Простые в первых и последних EDGE числах отрезка
+        self.head = []
+        self.tail = []
+        self.recent = deque()
+
+    def add(self, prime):
+        if self.last is not None:
+            gap = prime - self.last
+            if gap > self.max_gap:
+                self.max_gap = gap
+                self.max_gap_start = self.last
+        else:
+            self.first = prime
+        while self.recent and prime - self.recent[0] > EDGE:
+            self.recent.popleft()
+        for name, distance in PAIR_GAPS.items():
+            if prime - distance in self.recent:
+                self.pairs[name] += 1
+        self.recent.append(prime)
+        if prime < self.start + EDGE:
+            self.head.append(prime)
+        if prime > self.end - EDGE:
+            self.tail.append(prime)
+        self.last = prime
+        self.count += 1
+
+    def merge(self, other):
+        """Статистика объединения с отрезком, идущим сразу за этим"""
+        if other.start != self.end + 1:
+            raise ValueError(f"Отрезки не соседние: {self.end} и {other.start}")
+        merged = RangeStats(self.start, other.end)
+        merged.count = self.count + other.count
+        merged.first = self.first if self.first is not None else other.first
+        merged.last = other.last if other.last is not None else self.last
+        head = set(other.head)
+        for name, distance in PAIR_GAPS.items():
+            cross = sum(1 for prime in self.tail if prime + distance in head)
+            merged.pairs[name] = self.pairs[name] + other.pairs[name] + cross
+        merged.max_gap, merged.max_gap_start = self.max_gap, self.max_gap_start
+        candidates = [(other.max_gap, other.max_gap_start)]
+        if self.last is not None and other.first is not None:
+            candidates.insert(0, (other.first - self.last, self.last))
+        for gap, gap_start in candidates:
+            if gap > merged.max_gap:
+                merged.max_gap, merged.max_gap_start = gap, gap_start
+        edge_primes = self.head + self.tail + other.head + other.tail
+        merged.head = sorted({p for p in edge_primes if p < merged.start + EDGE})
+        merged.tail = sorted({p for p in edge_primes if p > merged.end - EDGE})
+        return merged
+
+    def to_ints(self):
+        """Представление для кадра RESULT; отсутствующие простые передаются нулем"""
+        return [self.start, self.end, self.count, self.first or 0, self.last or 0,
+                *(self.pairs[name] for name in PAIR_GAPS),
+                self.max_gap, self.max_gap_start or 0,
+                len(self.head), *self.head, len(self.tail), *self.tail]
+
+    @classmethod
+    def from_ints(cls, values):
+        stats = cls(values[0], values[1])
+        stats.count = values[2]
+        stats.first = values[3] or None
+        stats.last = values[4] or None
+        offset = 5
+        for name in PAIR_GAPS:
+            stats.pairs[name] = values[offset]
+            offset += 1
+        stats.max_gap = values[offset]
+        stats.max_gap_start = values[offset + 1] or None
+        offset += 2
+        size = values[offset]
+        stats.head = list(values[offset + 1:offset + 1 + size])
+        offset += 1 + size
+        size = values[offset]
+        stats.tail = list(values[offset + 1:offset + 1 + size])
+        return stats
+
+    def report(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'count': self.count,
+            'first': self.first,
+            'last': self.last,
+            **{f"{name}_pairs": count for name, count in self.pairs.items()},
+            'max_gap': self.max_gap,
+            'max_gap_start': self.max_gap_start,
+        }
+
+
+def merge_all(start, end, chunks):
+    """Склейка статистик участков, покрывающих [start, end] без пропусков
+
+    chunks - словарь {(начало, конец): RangeStats}.
+    """
+    total = RangeStats(start, start - 1)
+    for chunk in sorted(chunks):
+        total = total.merge(chunks[chunk])
+    if total.end != end:
+        raise ValueError(f"Участки не покрывают диапазон до {end}")
+    return total
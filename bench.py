@@ -0,0 +1,247 @@
+"""Воспроизводимые замеры производительности
+
+Три группы замеров: стоимость is_prime на одно число разной величины,
+скорость process_range на плотных и разреженных диапазонах и пропускная
+способность связки клиент-сервер с процентилями задержки против нескольких
+локально запущенных server.py. Результаты пишутся в JSON и сравниваются
+с сохраненной базовой линией:
+
+    python bench.py --output base.json
+    python bench.py --baseline base.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import protocol
+import server
+from connection import ConnectionPool
+
+# Все случайные числа берутся из генератора с фиксированным зерном
+SEED = 20240601
+# Порядки величины для замера is_prime
+PRIMALITY_DIGITS = [6, 12, 18, 30, 50, 100]
+# Диапазоны process_range: (имя, начало, ширина)
+RANGES = [
+    ("dense_1e7", 1, 10**7),
+    ("dense_1e12", 10**12, 10**7),
+    ("sparse_1e15", 10**15, 2 * 10**5),
+    ("sparse_1e30", 10**30, 2 * 10**4),
+]
+# Запросы сквозного замера: ширина и начало диапазона
+E2E_WIDTH = 20000
+E2E_START = 10**12
+SERVER_START_TIMEOUT = 30
+# Допустимое ухудшение относительно базовой линии
+DEFAULT_TOLERANCE = 0.10
+
+
+def timed(func, repeat):
+    """Медиана времени нескольких запусков, секунды"""
+    samples = []
+    for _ in range(repeat):
+        began = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - began)
+    return statistics.median(samples)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def bench_primality(rng, candidates, repeat):
+    """Стоимость is_prime на одно нечетное число заданной величины, мкс"""
+    results = {}
+    for digits in PRIMALITY_DIGITS:
+        low = 10 ** (digits - 1)
+        numbers = [rng.randrange(low, 10 * low) | 1 for _ in range(candidates)]
+        elapsed = timed(lambda: [server.is_prime(n) for n in numbers], repeat)
+        results[f"is_prime_1e{digits}"] = {
+            "value": elapsed / candidates * 1e6, "unit": "us/candidate", "better": "lower"}
+    return results
+
+
+def bench_ranges(engine, scale, repeat):
+    """Скорость process_range без кэша и индекса, чисел в секунду"""
+    results = {}
+    prime_server = server.PrimeServer(engine=engine)
+    for name, start, width in RANGES:
+        width = max(1000, int(width * scale))
+        end = start + width - 1
+        elapsed = timed(lambda: prime_server.process_range(start, end, 10000), repeat)
+        results[f"process_range_{name}"] = {
+            "value": width / elapsed, "unit": "numbers/s", "better": "higher"}
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def spawn_servers(count, workers, extra_args):
+    """Запуск серверов на свободных портах и ожидание их готовности"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    servers = []
+    for _ in range(count):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, script, "--host", "localhost", "--port", str(port),
+             "--workers", str(workers), "--cache-mb", "0", *extra_args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        servers.append((port, process))
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    for port, process in servers:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Сервер на порту {port} завершился при запуске")
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Сервер на порту {port} не запустился")
+                time.sleep(0.1)
+    return servers
+
+
+def stop_servers(servers):
+    for _, process in servers:
+        process.terminate()
+    for _, process in servers:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def bench_end_to_end(rng, server_count, requests, concurrency, workers, extra_args):
+    """Запросы в секунду и задержки через постоянные соединения к N серверам"""
+    servers = spawn_servers(server_count, workers, extra_args)
+    pools = [ConnectionPool("localhost", port) for port, _ in servers]
+    # Разные участки, чтобы ни один сервер не отвечал повторно на тот же запрос
+    starts = [E2E_START + i * E2E_WIDTH for i in range(requests)]
+    rng.shuffle(starts)
+
+    def one_request(index):
+        start = starts[index]
+        began = time.perf_counter()
+        frame_type, _ = pools[index % len(pools)].request(
+            protocol.request_frame, start, start + E2E_WIDTH - 1, 10000).wait(timeout=300)
+        if frame_type != protocol.RESULT:
+            raise RuntimeError(f"Неожиданный ответ сервера: {frame_type}")
+        return time.perf_counter() - began
+
+    try:
+        # Прогрев: соединения и базовые простые в каждом сервере
+        for index in range(len(pools)):
+            one_request(index)
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(one_request, range(requests)))
+        elapsed = time.perf_counter() - began
+    finally:
+        for pool in pools:
+            pool.close()
+        stop_servers(servers)
+
+    results = {"e2e_requests_per_s": {
+        "value": requests / elapsed, "unit": "req/s", "better": "higher"}}
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        results[f"e2e_latency_{name}"] = {
+            "value": percentile(latencies, fraction) * 1000, "unit": "ms", "better": "lower"}
+    return results
+
+
+def environment():
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": server.np is not None,
+        "gmpy2": server.gmpy2 is not None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Сравнение с базовой линией; возвращает список ухудшившихся замеров"""
+    regressions = []
+    print(f"{'benchmark':32} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None or not base["value"]:
+            print(f"{name:32} {'-':>14} {current['value']:14.4g} {'new':>8}")
+            continue
+        change = current["value"] / base["value"] - 1
+        worse = -change if current["better"] == "higher" else change
+        mark = ""
+        if worse > tolerance:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:32} {base['value']:14.4g} {current['value']:14.4g} "
+              f"{change:+8.1%}{mark}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замеры производительности поиска простых чисел')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='Compare against JSON results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative slowdown before a benchmark counts as regressed')
+    parser.add_argument('--only', choices=['primality', 'ranges', 'e2e'], action='append',
+                        help='Run only the given group (can be repeated)')
+    parser.add_argument('--quick', action='store_true',
+                        help='Smaller inputs and single runs for a fast smoke check')
+    parser.add_argument('--engine', choices=['python', 'numpy'], default='python',
+                        help='Primality engine for process_range and the spawned servers')
+    parser.add_argument('--servers', type=int, default=2, help='Servers to spawn for e2e')
+    parser.add_argument('--requests', type=int, default=200, help='Requests for e2e')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads for e2e')
+    parser.add_argument('--workers', type=int, default=4, help='Worker threads per server')
+    args = parser.parse_args()
+    if args.engine == 'numpy' and server.np is None:
+        parser.error('--engine numpy requires numpy to be installed')
+
+    groups = args.only or ['primality', 'ranges', 'e2e']
+    repeat = 1 if args.quick else 3
+    rng = random.Random(SEED)
+    results = {}
+    if 'primality' in groups:
+        results.update(bench_primality(rng, 200 if args.quick else 2000, repeat))
+    if 'ranges' in groups:
+        results.update(bench_ranges(args.engine, 0.1 if args.quick else 1, repeat))
+    if 'e2e' in groups:
+        requests = min(args.requests, 20) if args.quick else args.requests
+        results.update(bench_end_to_end(rng, args.servers, requests, args.concurrency,
+                                        args.workers, ['--engine', args.engine]))
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}")
+            raise SystemExit(1)
+    elif not args.output:
+        print(json.dumps(report, indent=2))
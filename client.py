@@ -6,24 +6,45 @@ from kivymd.uix.textfield import MDTextField
 from kivymd.uix.label import MDLabel
 from kivymd.uix.progressbar import MDProgressBar
 from kivymd.uix.dialog import MDDialog
-from kivymd.uix.list import TwoLineListItem, ThreeLineListItem
+from kivymd.uix.list import ThreeLineListItem
 from kivymd.uix.toolbar import MDTopAppBar
 from kivymd.uix.selectioncontrol import MDCheckbox
 from kivymd.uix.snackbar import Snackbar
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
 from kivy.clock import Clock
-import socket
+from kivy.lang import Builder
 from threading import Thread, Lock
 import random
 import math
 from functools import partial
-import subprocess
 import time
-import os
 from datetime import datetime
 from kivy.metrics import dp
+from coordinator import Coordinator, parse_servers
+from registry import ServerRegistry
 
+# Не чаще одного обновления интерфейса за кадр при 60 fps
+UI_REFRESH_INTERVAL = 1 / 60
+
+# Список результатов создает виджеты только для видимых строк,
+# сами результаты хранятся в data как словари
+Builder.load_string("""
+<ResultsView>:
+    viewclass: "TwoLineListItem"
+    do_scroll_x: False
+    RecycleBoxLayout:
+        orientation: "vertical"
+        default_size: None, dp(72)
+        default_size_hint: 1, None
+        size_hint_y: None
+        height: self.minimum_height
+""")
+
+
+class ResultsView(RecycleView):
+    pass
 
 
 class PrimeNumberApp(MDApp):
@@ -32,7 +53,6 @@ class PrimeNumberApp(MDApp):
         self.dialog = None
         self.calculation_thread = None
         self.is_calculating = False
-        self.use_fast_method = True
         self.server_mode = True
         self.max_number = 10**100
         self.server_address = "localhost"
@@ -44,6 +64,22 @@ class PrimeNumberApp(MDApp):
         self.server_lock = Lock()
         self.server_stats = {}
         self.cache = {}
+        self.server_labels = {}
+        # Обновления из рабочих потоков копятся здесь до ближайшего кадра
+        self.updates_lock = Lock()
+        self.pending_results = []
+        self.pending_status = {}
+        self.pending_summary = None
+        # Фоновый опрос серверов: UI читает только последнее известное состояние
+        self.registry = ServerRegistry(on_change=self.on_server_health)
+        self.coordinator = Coordinator(
+            registry=self.registry,
+            on_result=self.on_chunk_result,
+            on_progress=self.on_server_progress,
+            on_error=lambda message: Clock.schedule_once(lambda dt: self.show_error(message)),
+            on_notice=lambda message: Clock.schedule_once(
+                lambda dt: self.show_notification(message))
+        )
 
 
 
@@ -85,9 +121,16 @@ class PrimeNumberApp(MDApp):
             height=30
         )
         root_layout.add_widget(self.status_label)
-        
+
+        Clock.schedule_interval(self.flush_updates, UI_REFRESH_INTERVAL)
+        self.registry.set_servers(self.configured_servers())
+        self.registry.start()
         return self.screen
 
+    def on_stop(self):
+        self.registry.stop()
+        self.coordinator.close()
+
 
 
     def build_settings_card(self):
@@ -175,16 +218,20 @@ class PrimeNumberApp(MDApp):
         )
         card.add_widget(self.results_header)
 
-        # Scrollable Results
-        self.scroll_results = ScrollView(do_scroll_x=False)
-        self.results_list = BoxLayout(
-            orientation="vertical", 
-            size_hint_y=None, 
-            spacing=5
+        # Server Status
+        scroll_status = ScrollView(do_scroll_x=False, size_hint_y=0.3)
+        self.server_status_container = BoxLayout(
+            orientation="vertical",
+            size_hint_y=None
         )
-        self.results_list.bind(minimum_height=self.results_list.setter("height"))
-        self.scroll_results.add_widget(self.results_list)
-        card.add_widget(self.scroll_results)
+        self.server_status_container.bind(
+            minimum_height=self.server_status_container.setter("height"))
+        scroll_status.add_widget(self.server_status_container)
+        card.add_widget(scroll_status)
+
+        # Scrollable Results
+        self.results_view = ResultsView()
+        card.add_widget(self.results_view)
 
         # Summary
         self.summary_label = MDLabel(
@@ -199,7 +246,7 @@ class PrimeNumberApp(MDApp):
         return card
 
     
-    def update_server_status(self, server_id, port, start, end, current, primes_found):
+    def update_server_status(self, server_id, start, end, current, primes_found):
         """Обновляет статус сервера с правильным форматированием"""
         # Форматирование чисел с разделителями тысяч
         start_fmt = f"{start:,}".replace(",", " ")
@@ -207,21 +254,16 @@ class PrimeNumberApp(MDApp):
         current_fmt = f"{current:,}".replace(",", " ")
         
         status_text = (
-            f"[Сервер {server_id}] порт {port}\n"
+            f"[Сервер {server_id}]\n"
             f"Диапазон: {start_fmt} – {end_fmt}\n"
             f"Обработано: {current_fmt}\n"
             f"Простых: {primes_found if primes_found is not None else 'расчет...'}"
         )
 
-        # Ищем существующую метку или создаем новую
-        found = False
-        for child in self.server_status_container.children:
-            if hasattr(child, 'server_id') and child.server_id == server_id:
-                child.text = status_text
-                found = True
-                break
-
-        if not found:
+        label = self.server_labels.get(server_id)
+        if label is not None:
+            label.text = status_text
+        else:
             label = MDLabel(
                 text=status_text,
                 halign="left",
@@ -232,20 +274,12 @@ class PrimeNumberApp(MDApp):
                 font_style="Body1",  # Используем стандартный шрифт
                 line_height=1.0  # Стандартный межстрочный интервал
             )
-            label.server_id = server_id
+            self.server_labels[server_id] = label
             self.server_status_container.add_widget(label)
 
 
     def show_settings(self):
-        content = BoxLayout(orientation="vertical", spacing=15, size_hint_y=None, height=200)
-        
-        # Метод проверки
-        method_box = BoxLayout(orientation="horizontal", size_hint_y=None, height=50)
-        method_label = MDLabel(text="Быстрый метод (Миллер-Рабин):", halign="left", size_hint_x=0.7)
-        self.method_check = MDCheckbox(active=self.use_fast_method, size_hint_x=0.3)
-        self.method_check.bind(active=lambda i, v: setattr(self, 'use_fast_method', v))
-        method_box.add_widget(method_label)
-        method_box.add_widget(self.method_check)
+        content = BoxLayout(orientation="vertical", spacing=15, size_hint_y=None, height=150)
         
         # Режим работы
         mode_box = BoxLayout(orientation="horizontal", size_hint_y=None, height=50)
@@ -263,7 +297,6 @@ class PrimeNumberApp(MDApp):
         theme_box.add_widget(theme_label)
         theme_box.add_widget(self.theme_check)
         
-        content.add_widget(method_box)
         content.add_widget(mode_box)
         content.add_widget(theme_box)
         
@@ -290,8 +323,8 @@ class PrimeNumberApp(MDApp):
         
         # Информация о текущих серверах
         servers_info = MDLabel(
-            text="\n".join([f"Порт {port}: {info['workers']} потоков" 
-                        for port, info in self.servers.items()]) or "Нактивнычх серверов нет",
+            text="\n".join(self.format_server_state(state)
+                           for state in self.server_stats.values()) or "Нактивнычх серверов нет",
             halign="center",
             size_hint_y=None,
             height=100
@@ -377,20 +410,15 @@ class PrimeNumberApp(MDApp):
     def start_server_instance(self, port, workers):
         """Запуск одного экземпляра сервера как подпроцесса"""
         try:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            server_script = os.path.join(script_dir, "server.py")
-            
-            process = subprocess.Popen(
-                ["python", server_script, "--port", str(port), "--workers", str(workers)],
-                creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == 'nt' else 0
-            )
+            process = self.coordinator.spawn_server(port, workers, new_console=True)
             
             self.servers[port] = {
                 "process": process,
                 "workers": workers,
                 "start_time": time.time(),
-                "address": "localhost" 
+                "address": "localhost"
             }
+            self.registry.set_servers(self.configured_servers())
             
             self.update_status(f"Сервер на порту {port} запущен")
             self.show_notification(f"Сервер на порту {port} запущен с {workers} потоками")
@@ -399,33 +427,50 @@ class PrimeNumberApp(MDApp):
             self.show_error(f"Ошибка запуска сервера: {str(e)}")
             
     def check_servers_status(self):
-        """Проверка статуса всех серверов"""
-        for port in list(self.servers.keys()):
-            try:
-                with socket.create_connection(("localhost", port), timeout=2) as sock:
-                    sock.sendall(b"status")
-                    response = sock.recv(1024).decode()
-                    self.server_stats[port] = eval(response)
-            except:
-                # Сервер не отвечает, удаляем его
+        """Статус серверов по данным фонового опроса, без ожидания сети"""
+        for port, info in list(self.servers.items()):
+            if info["process"].poll() is not None:
+                # Процесс сервера завершился, удаляем его
                 self.servers.pop(port, None)
-                self.show_error(f"Сервер на порту {port} не отвечает и был удален")
+                self.registry.set_servers(self.configured_servers())
+                self.coordinator.close_pool(info["address"], port)
+                self.show_error(f"Сервер на порту {port} завершился и был удален")
+        self.server_stats = {(state["address"], state["port"]): state
+                             for state in self.registry.snapshot()}
+
+    def format_server_state(self, state):
+        """Строка состояния сервера для диалога управления"""
+        name = f"{state['address']}:{state['port']}"
+        if state["healthy"] is None:
+            return f"{name}: проверка..."
+        if not state["healthy"]:
+            return f"{name}: не отвечает"
+        return (f"{name}: {state['latency'] * 1000:.0f} мс, CPU {state['cpu_load']:.0f}%, "
+                f"соединений {state['active_connections']}")
+
+    def on_server_health(self, address, port, healthy):
+        """Сервер стал доступен или перестал отвечать (вызывается из потока опроса)"""
+        if healthy:
+            message = f"Сервер {address}:{port} доступен"
+            Clock.schedule_once(lambda dt: self.update_status(message))
+        else:
+            message = f"Сервер {address}:{port} не отвечает"
+            Clock.schedule_once(lambda dt: self.show_notification(message))
 
+    def configured_servers(self):
+        """Запущенные здесь серверы и серверы из настроек подключения"""
+        servers = [(info["address"], port) for port, info in self.servers.items()]
+        servers += parse_servers(self.server_address, self.server_port)
+        return list(dict.fromkeys(servers))
 
     def stop_all_servers(self, *args):
         """Остановка всех запущенных серверов"""
         for port, server_info in list(self.servers.items()):
-            try:
-                server_info["process"].terminate()
-                server_info["process"].wait(timeout=3)
-                self.update_status(f"Сервер на порту {port} остановлен")
-            except:
-                try:
-                    server_info["process"].kill()
-                except:
-                    pass
-            finally:
-                self.servers.pop(port, None)
+            self.coordinator.stop_server(server_info["process"])
+            self.coordinator.close_pool(server_info["address"], port)
+            self.servers.pop(port, None)
+            self.registry.set_servers(self.configured_servers())
+            self.update_status(f"Сервер на порту {port} остановлен")
         
         if self.dialog:
             self.dialog.dismiss()
@@ -471,143 +516,81 @@ class PrimeNumberApp(MDApp):
         try:
             self.server_address = self.server_addr_input.text
             self.server_port = int(self.server_port_input.text)
+            self.registry.set_servers(self.configured_servers())
             self.dialog.dismiss()
             self.show_notification("Настройки серверов сохранены")
         except ValueError:
             self.show_error("Неверный формат порта")
 
     def run_calculation(self, start, end, workers, batch_size, calculation_id):
-        total_primes = 0
-        total_numbers = end - start + 1
-        
-        active_servers = [(info["address"], port) for port, info in self.servers.items()]
-        if not active_servers:
-            Clock.schedule_once(lambda dt: self.show_error("Нет доступных серверов"))
-            return
-
-        ranges = self.distribute_range(start, end, len(active_servers))
-        
-        for i, (r_start, r_end) in enumerate(ranges):
-            if not self.is_calculating or calculation_id != self.current_calculation_id:
+        """Расчет через координатор: на доступных серверах или локально"""
+        servers = None
+        if self.server_mode:
+            servers = self.configured_servers()
+            self.registry.set_servers(servers)
+            if not servers:
+                Clock.schedule_once(lambda dt: self.show_error("Нет доступных серверов"))
                 return
-                
-            if i >= len(active_servers):
-                break
-                
-            address, port = active_servers[i]
-            try:
-                with socket.create_connection((address, port), timeout=300) as sock:
-                    sock.sendall(f"{r_start},{r_end},{batch_size}".encode())
-                    
-                    while True:
-                        try:
-                            response = sock.recv(1024).decode().strip()
-                        except:
-                            break
-
-                        if not response:
-                            break
-
-                        if response.startswith("STATUS:"):
-                            # Убрали обновление статуса
-                            continue
-
-                        if "END" in response:
-                            number_part = response.replace("END", "").strip()
-                            if number_part.isdigit():
-                                count = int(number_part)
-                                total_primes += count
-                                Clock.schedule_once(partial(
-                                    self.update_results,
-                                    r_start, r_end, count, total_primes,
-                                    i+1, len(ranges), total_numbers
-                                ))
-                            break
-
-                        elif response.strip().isdigit():
-                            count = int(response.strip())
-                            total_primes += count
-                            Clock.schedule_once(partial(
-                                self.update_results,
-                                r_start, r_end, count, total_primes,
-                                i+1, len(ranges), total_numbers
-                            ))
-                            continue
-
-                        else:
-                            print(f"[!] Неизвестный ответ от сервера: {response}")
-                            break
-
-            except Exception as e:
-                error_msg = str(e)[:100]
-                Clock.schedule_once(lambda dt, msg=error_msg: 
-                    self.show_error(f"Ошибка сервера {port}: {msg}"))
-                continue
-            
-        Clock.schedule_once(partial(self.finish_calculation, total_primes))
-
-
 
-    def distribute_range(self, total_start, total_end, workers):
-        """Распределение диапазона между серверами"""
-        total = total_end - total_start + 1
-        chunk = total // workers
-        return [
-            (
-                total_start + i * chunk,
-                total_start + (i + 1) * chunk - 1 if i < workers - 1 else total_end
-            ) 
-            for i in range(workers)
-        ]
-
-    def server_request(self, start, end, batch_size):
-        """Отправка запроса на сервер"""
-        try:
-            with socket.create_connection(
-                (self.server_address.strip(), self.server_port), 
-                timeout=300
-            ) as sock:
-                sock.sendall(f"{start},{end},{batch_size}".encode())
-                response = sock.recv(1024).decode()
-                if response.isdigit():
-                    return int(response)
-                return 0
-        except Exception as e:
-            Clock.schedule_once(lambda dt: self.show_error(f"Ошибка сервера: {str(e)[:100]}"))
-            return 0
-
-    def update_results(self, start, end, count, total, current, total_workers, total_numbers, *args):
-        """Обновление результатов в UI"""
+        cancelled = lambda: (not self.is_calculating
+                             or calculation_id != self.current_calculation_id)
+        self.coordinator.batch_size = batch_size
+        total = self.coordinator.run(start, end, servers, workers, cancelled)
+        if total is not None:
+            Clock.schedule_once(partial(self.finish_calculation, total))
+        elif not cancelled():
+            Clock.schedule_once(self.stop_calculation)
+
+    def on_chunk_result(self, chunk, count, total, completed, processed, total_numbers):
+        """Готовый участок от координатора (вызывается из рабочего потока)"""
+        item = {
+            "text": f"[{chunk[0]:,} – {chunk[1]:,}]",
+            "secondary_text": f"Найдено простых: {count}",
+        }
+        with self.updates_lock:
+            self.pending_results.append(item)
+            self.pending_summary = (total, completed, processed, total_numbers)
+
+    def on_server_progress(self, worker, chunk, current, count):
+        """Прогресс сервера по участку (вызывается из рабочего потока)
+
+        Хранится только последнее состояние каждого сервера.
+        """
+        with self.updates_lock:
+            self.pending_status[worker] = (chunk, current, count)
+
+    def flush_updates(self, *args):
+        """Перенос накопленных обновлений в UI, не чаще раза за кадр"""
+        with self.updates_lock:
+            results, self.pending_results = self.pending_results, []
+            status, self.pending_status = self.pending_status, {}
+            summary, self.pending_summary = self.pending_summary, None
         if not self.is_calculating:
             return
 
-        # Обновление прогресса (по количеству полученных результатов)
-        progress = (current / total_workers) * 100
-        self.progress.value = progress
+        for worker, (chunk, current, count) in status.items():
+            self.update_server_status(worker, chunk[0], chunk[1], current, count)
 
-        # Элемент списка результатов
-        item = TwoLineListItem(
-            text=f"[{start:,} – {end:,}]",
-            secondary_text=f"Найдено простых: {count}",
-            theme_text_color="Primary",
-            secondary_theme_text_color="Secondary"
-        )
-        self.results_list.add_widget(item)
-
-        # Обновление сводки
-        self.summary_label.text = f"Всего найдено: {total:,}"
-
-        # Обновление статуса
-        self.status_label.text = f"Выполнено: {current} из {total_workers} участков"
+        if results:
+            # Одно изменение data - одна перестройка видимых строк
+            self.results_view.data.extend(results)
+            self.results_view.scroll_y = 0
 
-        # Скроллим вниз
-        Clock.schedule_once(lambda dt: self.scroll_results.scroll_to(item), 0.1)
+        if summary is not None:
+            total, completed, processed, total_numbers = summary
+            # Обновление прогресса (по количеству обработанных чисел)
+            progress = (processed / total_numbers) * 100
+            self.progress.value = progress
+            self.summary_label.text = f"Всего найдено: {total:,}"
+            self.status_label.text = f"Выполнено участков: {completed} ({progress:.1f}%)"
 
     def finish_calculation(self, total_primes, *args):
         """Завершение расчета"""
         if not self.is_calculating:
             return
-            
+
+        # Участки, пришедшие после последнего кадра, попадают в список до итога
+        self.flush_updates()
         self.is_calculating = False
         self.calc_btn.text = "НАЧАТЬ РАСЧЕТ"
         self.stop_btn.disabled = True
@@ -670,7 +653,13 @@ class PrimeNumberApp(MDApp):
     def prepare_for_calculation(self):
         """Подготовка интерфейса к расчету"""
         self.is_calculating = True
-        self.results_list.clear_widgets()
+        with self.updates_lock:
+            self.pending_results = []
+            self.pending_status = {}
+            self.pending_summary = None
+        self.results_view.data = []
+        self.server_status_container.clear_widgets()
+        self.server_labels = {}
         self.calc_btn.text = "ПАУЗА"
         self.stop_btn.disabled = False
         self.progress.value = 0
@@ -692,10 +681,11 @@ class PrimeNumberApp(MDApp):
 
 Параметры:
 - Начало/конец диапазона: границы поиска
-- Потоки: количество серверов
+- Потоки: число процессов при локальном расчете
 - Размер пакета: чисел за одну итерацию
 
 Режимы работы:
+- Локальный: вычисления на всех ядрах этого компьютера
 - Серверный: вычисления на удаленных серверах
 - Можно запускать несколько серверов
 
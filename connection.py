@@ -0,0 +1,267 @@
+import json
+import queue
+import socket
+import time
+from threading import Thread, Lock
+
+import protocol
+
+CONNECT_TIMEOUT = 5
+# Сколько соединений держать открытыми с одним сервером
+MAX_CONNECTIONS = 4
+# Сколько запросов можно отправить в одно соединение, не дожидаясь ответов
+PIPELINE_DEPTH = 2
+# Период проверки отмены при ожидании ответа, секунды
+POLL_INTERVAL = 0.5
+# Сколько кадров потокового ответа принимается впрок; дальше чтение
+# приостанавливается, и сервер упирается в заполненный буфер TCP
+STREAM_FRAMES = 16
+
+
+class PendingRequest:
+    """Ожидание ответа на один запрос в постоянном соединении"""
+
+    def __init__(self, connection, request_id, max_frames=0):
+        self.connection = connection
+        self.request_id = request_id
+        self.frames = queue.Queue(max_frames)
+        self.profile = None
+        self.count = None
+        self.owns_connection = False
+
+    def next_frame(self, deadline=None, cancelled=None):
+        """Следующий кадр ответа или None, если cancelled() стал истинным
+
+        Кадр профиля сохраняется в self.profile, кадр ошибки - исключение
+        (ServerBusy, если сервер перегружен и не принял запрос).
+        """
+        while True:
+            if cancelled is not None and cancelled():
+                self.discard()
+                return None
+            poll = POLL_INTERVAL
+            if deadline is not None:
+                poll = min(poll, deadline - time.monotonic())
+                if poll <= 0:
+                    self.discard()
+                    raise TimeoutError("Сервер не ответил вовремя")
+            try:
+                frame_type, payload = self.frames.get(timeout=poll)
+            except queue.Empty:
+                if self.connection.closed and self.frames.empty():
+                    raise ConnectionError("Соединение с сервером потеряно")
+                continue
+            if frame_type is None:
+                raise ConnectionError("Соединение с сервером потеряно")
+            if frame_type == protocol.PROFILE:
+                self.profile = json.loads(payload)
+                continue
+            if frame_type == protocol.BUSY:
+                raise protocol.ServerBusy(protocol.decode_busy(payload))
+            if frame_type == protocol.ERROR:
+                raise protocol.ProtocolError(payload.decode(errors="replace"))
+            return frame_type, payload
+
+    def wait(self, timeout=None, cancelled=None, on_progress=None):
+        """Ожидание итогового кадра
+
+        Кадры прогресса передаются в on_progress(num, count), если он задан,
+        иначе пропускаются. Возвращает (тип, нагрузка) или None, если
+        cancelled() стал истинным. Профиль задачи, если сервер его прислал,
+        сохраняется в self.profile.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.next_frame(deadline, cancelled)
+            if frame is None or frame[0] not in (protocol.PROGRESS, protocol.PRIMES):
+                return frame
+            if frame[0] == protocol.PROGRESS and on_progress is not None:
+                on_progress(*protocol.decode_ints(frame[1]))
+
+    def primes(self, timeout=None, cancelled=None):
+        """Простые из кадров PRIMES по мере поступления
+
+        timeout - наибольшая пауза между кадрами. Генератор завершается
+        на кадре RESULT (количество простых остается в self.count); если
+        его закрыть раньше, сервер получает отмену.
+        """
+        finished = False
+        try:
+            while True:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                frame = self.next_frame(deadline, cancelled)
+                if frame is None:
+                    finished = True
+                    return
+                frame_type, payload = frame
+                if frame_type == protocol.PRIMES:
+                    yield from protocol.decode_primes(payload)
+                elif frame_type == protocol.RESULT:
+                    self.count = protocol.decode_ints(payload)[0]
+                    finished = True
+                    return
+        finally:
+            if not finished:
+                self.discard()
+            if self.owns_connection:
+                self.connection.close()
+
+    def close(self):
+        """Отказ от ответа, который больше не будет прочитан"""
+        self.discard()
+        if self.owns_connection:
+            self.connection.close()
+
+    def discard(self):
+        """Отказ от ответа: сервер получает отмену и прекращает расчет"""
+        self.connection.cancel(self.request_id)
+        # Поток чтения мог остановиться на заполненной очереди потокового ответа
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+
+
+class ServerConnection:
+    """Постоянное соединение с сервером с конвейерной отправкой запросов
+
+    Фоновый поток читает кадры и раскладывает их по запросам
+    в соответствии с идентификатором из заголовка.
+    """
+
+    def __init__(self, address, port, timeout=CONNECT_TIMEOUT):
+        self.address = address
+        self.port = port
+        self.sock = socket.create_connection((address, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.send_lock = Lock()
+        self.lock = Lock()
+        self.pending = {}
+        self.next_id = 1
+        self.closed = False
+        self.reader = Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+    def send(self, build_frame, *args, max_frames=0):
+        """Отправка кадра под новым id запроса
+
+        max_frames ограничивает очередь принятых кадров для потоковых ответов.
+        """
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Соединение закрыто")
+            request_id = self.next_id
+            self.next_id = self.next_id % 0xFFFFFFFF + 1
+            request = PendingRequest(self, request_id, max_frames)
+            self.pending[request_id] = request
+        try:
+            with self.send_lock:
+                self.sock.sendall(build_frame(*args, request_id=request_id))
+        except OSError:
+            self.close()
+            raise
+        return request
+
+    def cancel(self, request_id):
+        """Отмена запроса: ответ больше не ждем, серверу отправляется CANCEL"""
+        with self.lock:
+            if self.pending.pop(request_id, None) is None or self.closed:
+                return
+        try:
+            with self.send_lock:
+                self.sock.sendall(protocol.cancel_frame(request_id))
+        except OSError:
+            self.close()
+
+    def read_loop(self):
+        reader = protocol.FrameReader(self.sock)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                with self.lock:
+                    if frame_type in (protocol.PROGRESS, protocol.PROFILE, protocol.PRIMES):
+                        request = self.pending.get(request_id)
+                    else:
+                        request = self.pending.pop(request_id, None)
+                if request is not None:
+                    request.frames.put((frame_type, payload))
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for request in pending:
+            try:
+                request.frames.put_nowait((None, b""))
+            except queue.Full:
+                pass  # ожидающий заметит закрытие соединения сам
+
+
+class ConnectionPool:
+    """Пул постоянных соединений с одним сервером"""
+
+    def __init__(self, address, port, max_connections=MAX_CONNECTIONS,
+                 pipeline_depth=PIPELINE_DEPTH):
+        self.address = address
+        self.port = port
+        self.max_connections = max_connections
+        self.pipeline_depth = pipeline_depth
+        self.connections = []
+        self.streams = []
+        self.lock = Lock()
+
+    def acquire(self):
+        """Наименее загруженное соединение; новое открывается, если все заняты"""
+        with self.lock:
+            self.connections = [c for c in self.connections if not c.closed]
+            best = min(self.connections, key=lambda c: c.in_flight, default=None)
+            if best is not None and (best.in_flight < self.pipeline_depth
+                                     or len(self.connections) >= self.max_connections):
+                return best
+            connection = ServerConnection(self.address, self.port)
+            self.connections.append(connection)
+            return connection
+
+    def request(self, build_frame, *args, **kwargs):
+        return self.acquire().send(build_frame, *args, **kwargs)
+
+    def enumerate(self, start, end, batch_size):
+        """Запрос простых диапазона; читать их - через primes() у результата
+
+        Перечисление идет по отдельному соединению, которое закрывается вместе
+        с потоком: приостановленное чтение не должно задерживать чужие ответы.
+        """
+        connection = ServerConnection(self.address, self.port)
+        with self.lock:
+            self.streams = [c for c in self.streams if not c.closed]
+            self.streams.append(connection)
+        request = connection.send(protocol.enumerate_frame, start, end, batch_size,
+                                  max_frames=STREAM_FRAMES)
+        request.owns_connection = True
+        return request
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections + self.streams, []
+            self.streams = []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,591 @@
+"""Координатор распределенного расчета без графического интерфейса
+
+Раздает участки диапазона серверам (или процессам этого компьютера),
+ведет журнал готовых участков и собирает итог. Используется и клиентом
+на Kivy, и из командной строки:
+
+    python coordinator.py 1 1000000000000 --servers host1,host2:5556
+    python coordinator.py 1 10000000 --spawn 2 --stream
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from threading import Event, Lock
+
+import protocol
+from analytics import RangeStats, merge_all
+from connection import ConnectionPool, PIPELINE_DEPTH, POLL_INTERVAL
+from journal import JobJournal, JOURNAL_DIR, journal_path
+from registry import ServerRegistry
+from scheduler import ChunkScheduler
+
+DEFAULT_PORT = 5555
+DEFAULT_BATCH = 10000
+# Ширина участка при перечислении простых серверами
+ENUMERATE_CHUNK = 10**7
+SERVER_START_TIMEOUT = 30
+
+
+def parse_servers(text, default_port=DEFAULT_PORT):
+    """Разбор списка серверов "host1,host2:5556": без порта берется default_port"""
+    servers = []
+    for entry in text.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(":")
+        if host and port.isdigit():
+            servers.append((host, int(port)))
+        else:
+            servers.append((entry, default_port))
+    return servers
+
+
+class Coordinator:
+    """Распределенный расчет количества простых в диапазоне
+
+    Обратные вызовы (все необязательные) вызываются из рабочих потоков:
+    on_result(chunk, count, total, completed, processed, total_numbers) - готов участок,
+    on_progress(worker, chunk, current, count) - сервер (или "local") дошел
+    до числа current участка chunk и нашел в нем count простых,
+    on_error(message) - ошибка сервера или расчета,
+    on_notice(message) - информационное сообщение.
+    С реестром серверов (registry) работа идет только на доступных серверах,
+    а перегруженные пропускают новые участки.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH, use_journal=True, journal_dir=JOURNAL_DIR,
+                 on_result=None, on_progress=None, on_error=None, on_notice=None,
+                 registry=None):
+        self.batch_size = batch_size
+        self.registry = registry
+        self.use_journal = use_journal
+        self.journal_dir = journal_dir
+        self.on_result = on_result or (lambda *args: None)
+        self.on_progress = on_progress or (lambda *args: None)
+        self.on_error = on_error or (lambda message: None)
+        self.on_notice = on_notice or (lambda message: None)
+        self.pools = {}
+        self.lock = Lock()
+
+    def get_pool(self, address, port):
+        """Пул постоянных соединений с сервером"""
+        with self.lock:
+            key = (address, port)
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(address, port)
+            return self.pools[key]
+
+    def close_pool(self, address, port):
+        with self.lock:
+            pool = self.pools.pop((address, port), None)
+        if pool is not None:
+            pool.close()
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def spawn_server(self, port, workers, new_console=False, stdout=None):
+        """Запуск экземпляра server.py на этом компьютере"""
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        creationflags = 0
+        if new_console and os.name == 'nt':
+            creationflags = subprocess.CREATE_NEW_CONSOLE
+        return subprocess.Popen(
+            [sys.executable, server_script, "--port", str(port), "--workers", str(workers)],
+            creationflags=creationflags, stdout=stdout
+        )
+
+    def wait_ready(self, address, port, process=None, timeout=SERVER_START_TIMEOUT):
+        """Ожидание, пока сервер начнет принимать соединения"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Сервер на порту {port} завершился при запуске")
+            try:
+                socket.create_connection((address, port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Сервер {address}:{port} не отвечает")
+                time.sleep(0.1)
+
+    def stop_server(self, process, timeout=3):
+        try:
+            process.terminate()
+            process.wait(timeout=timeout)
+        except Exception:
+            try:
+                process.kill()
+            except Exception:
+                pass
+
+    def available(self, servers):
+        """Доступные серверы из списка, от наименее загруженного"""
+        if self.registry is None:
+            return servers
+        available = self.registry.select(servers)
+        if not available:
+            # Серверы могли запуститься уже после последнего опроса
+            self.registry.probe_all(wait_results=True)
+            available = self.registry.select(servers)
+        return available
+
+    def accepts_work(self, address, port):
+        return self.registry is None or self.registry.accepts_work(address, port)
+
+    def min_chunk(self, start, end, analytics=None):
+        """Наименьший участок для планировщика
+
+        Диапазон, который сервер считает через pi(x), не делится: каждый
+        участок стоил бы двух полных вычислений pi(x) около end.
+        Статистика требует перечисления простых, и для нее это неверно.
+        """
+        from server import use_lucy
+        if analytics is None and use_lucy(start, end):
+            return end - start + 1
+        return self.batch_size
+
+    def run(self, start, end, servers=None, workers=1, cancelled=None, analytics=None):
+        """Расчет на серверах или, если их нет, на workers процессах этого компьютера
+
+        Возвращает количество простых или None, если расчет отменен
+        или остались необработанные участки (они сохранены в журнале).
+        Если передан словарь analytics, в него собирается статистика
+        участков: {(начало, конец): RangeStats}.
+        """
+        cancelled = cancelled or (lambda: False)
+        if servers:
+            return self.run_servers(start, end, servers, cancelled, analytics)
+        return self.run_local(start, end, workers, cancelled, analytics)
+
+    def analyze(self, start, end, servers=None, workers=1, cancelled=None):
+        """Количество простых, пары и наибольший промежуток за один проход
+
+        Участки считаются как в run, их статистики склеиваются по порядку.
+        Возвращает словарь (RangeStats.report) или None, как run.
+        """
+        chunks = {}
+        if self.run(start, end, servers, workers, cancelled, chunks) is None:
+            return None
+        return merge_all(start, end, chunks).report()
+
+    def iter_primes(self, start, end, servers=None, chunk_size=ENUMERATE_CHUNK, cancelled=None):
+        """Простые диапазона по возрастанию, без накопления в памяти
+
+        Участки по chunk_size чисел перечисляются серверами параллельно
+        (по одному на сервер), а выдаются строго по порядку: пока читается
+        один участок, остальные серверы упираются в ограниченный буфер
+        потока и ждут. Без серверов простые считаются в этом процессе.
+        Если ни один из переданных серверов не отвечает - ConnectionError.
+        """
+        cancelled = cancelled or (lambda: False)
+        if not servers:
+            from server import iter_primes, JobAborted
+            try:
+                yield from iter_primes(start, end, self.batch_size,
+                                       lambda num, count: not cancelled())
+            except JobAborted:
+                pass
+            return
+
+        servers = self.available(list(dict.fromkeys(servers)))
+        if not servers:
+            self.on_error("Нет доступных серверов")
+            raise ConnectionError("Нет доступных серверов")
+        chunks = ((lo, min(lo + chunk_size - 1, end)) for lo in range(start, end + 1, chunk_size))
+        in_flight = deque()
+
+        def submit(address, port, chunk=None):
+            chunk = chunk or next(chunks, None)
+            if chunk is not None:
+                request = self.get_pool(address, port).enumerate(*chunk, self.batch_size)
+                in_flight.append((address, port, chunk, request))
+
+        try:
+            for address, port in servers:
+                submit(address, port)
+            while in_flight and not cancelled():
+                address, port, chunk, request = in_flight.popleft()
+                try:
+                    yield from request.primes(cancelled=cancelled)
+                except protocol.ServerBusy as e:
+                    # Отказ приходит до первого простого: участок отправляется
+                    # следующему серверу, а он выдается первым, как и раньше
+                    time.sleep(e.retry_after / len(servers))
+                    following = servers[(servers.index((address, port)) + 1) % len(servers)]
+                    submit(*following, chunk)
+                    in_flight.rotate(1)
+                    continue
+                submit(address, port)
+        finally:
+            for _, _, _, request in in_flight:
+                request.close()
+
+    def open_journal(self, start, end, analytics=None):
+        """Журнал готовых участков: повторный запуск диапазона продолжает расчет
+
+        У расчета со статистикой свой журнал, и статистика готовых участков
+        из него попадает в analytics.
+        """
+        if not self.use_journal:
+            return None
+        path = journal_path(start, end, self.journal_dir, analytics is not None)
+        journal = JobJournal(path, start, end)
+        if analytics is not None:
+            analytics.update((chunk, RangeStats.from_ints(values))
+                             for chunk, values in journal.analytics.items())
+        if journal.counts:
+            self.on_notice(f"Продолжение прерванного расчета: готово участков {len(journal.counts)}")
+        return journal
+
+    def close_journal(self, journal, scheduler):
+        """Журнал завершенного расчета больше не нужен, прерванного - сохраняется"""
+        if journal is None:
+            return
+        if scheduler.finished():
+            journal.remove()
+        else:
+            journal.close()
+
+    def run_servers(self, start, end, servers, cancelled, analytics=None):
+        servers = self.available(servers)
+        if not servers:
+            self.on_error("Нет доступных серверов")
+            return None
+        total_numbers = end - start + 1
+        journal = self.open_journal(start, end, analytics)
+        completed = journal.chunks if journal is not None else ()
+        # Участки выдаются серверам по мере освобождения, размер участка
+        # подстраивается под измеренную скорость каждого сервера
+        scheduler = ChunkScheduler(start, end, len(servers),
+                                   min_chunk=self.min_chunk(start, end, analytics),
+                                   completed=completed)
+        results_lock = Lock()
+        totals = {"primes": journal.total if journal is not None else 0,
+                  "chunks": len(completed)}
+
+        def on_result(chunk, count, stats=None):
+            if journal is not None:
+                journal.record(chunk, count, stats.to_ints() if stats is not None else None)
+            with results_lock:
+                if analytics is not None:
+                    analytics[chunk] = stats
+                totals["primes"] += count
+                totals["chunks"] += 1
+                self.on_result(chunk, count, totals["primes"], totals["chunks"],
+                               scheduler.processed, total_numbers)
+
+        executor = ThreadPoolExecutor(max_workers=len(servers))
+        try:
+            pending = {
+                executor.submit(self.serve_chunks, scheduler, address, port,
+                                cancelled, on_result, analytics is not None): (address, port)
+                for address, port in servers
+            }
+
+            while pending:
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                if cancelled():
+                    return None
+
+                for future in done:
+                    # Участки упавшего сервера вернулись в планировщик и достанутся остальным
+                    address, port = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.on_error(f"Ошибка сервера {address}:{port}: {str(e)[:100]}")
+        finally:
+            # Не ждем потоки отмененного расчета, они завершатся сами
+            executor.shutdown(wait=False)
+            self.close_journal(journal, scheduler)
+
+        if not scheduler.finished():
+            self.on_error("Не все участки обработаны: нет работающих серверов. "
+                          "Готовые участки сохранены, расчет продолжится при следующем запуске")
+            return None
+        return totals["primes"]
+
+    def run_local(self, start, end, workers, cancelled, analytics=None):
+        """Расчет на ядрах этого компьютера тем же движком, что и на сервере"""
+        # Движок сервера импортируется по необходимости: его импорт заметно дольше
+        from server import count_range_task, analyze_range_task, init_worker
+
+        total_numbers = end - start + 1
+        journal = self.open_journal(start, end, analytics)
+        completed_chunks = journal.chunks if journal is not None else ()
+        total_primes = journal.total if journal is not None else 0
+        completed = len(completed_chunks)
+        scheduler = ChunkScheduler(start, end, workers,
+                                   min_chunk=self.min_chunk(start, end, analytics),
+                                   completed=completed_chunks)
+        # Общий флаг отмены: задачи пула проверяют его по ходу подсчета
+        cancel_flags = multiprocessing.Array('b', 1, lock=False)
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(cancel_flags,)) as pool:
+                pending = {}
+
+                def submit_next():
+                    chunk = scheduler.next_chunk("local")
+                    if chunk is not None:
+                        task = count_range_task if analytics is None else analyze_range_task
+                        future = pool.submit(task, chunk[0], chunk[1], self.batch_size, 0)
+                        pending[future] = chunk
+
+                # Очередь на одну задачу длиннее числа процессов, чтобы они не простаивали
+                for _ in range(workers * 2):
+                    submit_next()
+
+                while pending:
+                    done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    if cancelled():
+                        cancel_flags[0] = 1
+                        for future in pending:
+                            future.cancel()
+                        return None
+
+                    for future in done:
+                        chunk = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            cancel_flags[0] = 1
+                            self.on_error(f"Ошибка локального расчета: {str(e)[:100]}")
+                            return None
+
+                        stats = None
+                        count = result
+                        if analytics is not None:
+                            stats, count = result, result.count
+                            analytics[chunk] = stats
+                        if journal is not None:
+                            journal.record(chunk, count,
+                                           stats.to_ints() if stats is not None else None)
+                        scheduler.complete(chunk)
+                        self.on_progress("local", chunk, chunk[1], count)
+                        completed += 1
+                        total_primes += count
+                        self.on_result(chunk, count, total_primes, completed,
+                                       scheduler.processed, total_numbers)
+                        submit_next()
+        finally:
+            self.close_journal(journal, scheduler)
+
+        return total_primes
+
+    def serve_chunks(self, scheduler, address, port, cancelled, on_result, analytics=False):
+        """Обработка участков одним сервером, пока планировщик выдает работу
+
+        В соединения сервера отправляется до PIPELINE_DEPTH участков сразу,
+        чтобы сервер не простаивал между ответом и следующим запросом.
+        С analytics участки запрашиваются со статистикой, и она передается
+        третьим аргументом on_result.
+        """
+        build_frame = protocol.analyze_frame if analytics else protocol.request_frame
+        pool = self.get_pool(address, port)
+        worker = (address, port)
+        name = f"{address}:{port}"
+        in_flight = deque()
+        last_done = time.monotonic()
+        # До этого момента сервер, отклонивший участок, новых не получает
+        busy_until = 0
+        # Сервер, переставший отвечать на опросы, но не закрывший соединение
+        lost = False
+
+        def unhealthy():
+            return self.registry is not None and not self.registry.is_healthy(address, port)
+
+        try:
+            while not cancelled():
+                while (len(in_flight) < PIPELINE_DEPTH and time.monotonic() >= busy_until
+                       and self.accepts_work(address, port)):
+                    chunk = scheduler.next_chunk(worker)
+                    if chunk is None:
+                        break
+                    try:
+                        request = pool.request(build_frame, chunk[0], chunk[1], self.batch_size)
+                    except Exception:
+                        scheduler.fail(chunk)
+                        raise
+                    in_flight.append((chunk, time.monotonic(), request))
+                if not in_flight:
+                    if scheduler.finished():
+                        return
+                    if unhealthy():
+                        self.on_notice(f"Сервер {name} недоступен, участки достанутся другим")
+                        return
+                    # Сервер перегружен или остальные участки еще у других серверов;
+                    # если какой-то из них упадет, его участки вернутся в планировщик
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                chunk, sent, request = in_flight[0]
+                try:
+                    frame = request.wait(
+                        cancelled=lambda: cancelled() or unhealthy(),
+                        on_progress=lambda num, count: self.on_progress(name, chunk, num, count))
+                except protocol.ServerBusy as e:
+                    # Сервер перегружен: участок достанется другим, а этот сервер
+                    # выдерживает подсказанную паузу
+                    in_flight.popleft()
+                    scheduler.fail(chunk)
+                    busy_until = time.monotonic() + e.retry_after
+                    continue
+                if frame is None:
+                    if not cancelled():
+                        lost = True
+                        self.on_notice(f"Сервер {name} недоступен, участки достанутся другим")
+                    return
+                in_flight.popleft()
+                frame_type, payload = frame
+                if frame_type != protocol.RESULT:
+                    raise protocol.ProtocolError(f"Неожиданный кадр от сервера: тип {frame_type}")
+
+                now = time.monotonic()
+                # Участок начал считаться не раньше, чем сервер закончил предыдущий
+                scheduler.complete(chunk, now - max(sent, last_done))
+                last_done = now
+                count, values = protocol.decode_result(payload)
+                self.on_progress(name, chunk, chunk[1], count)
+                if analytics:
+                    on_result(chunk, count, RangeStats.from_ints(values))
+                else:
+                    on_result(chunk, count)
+        finally:
+            # Необработанные участки достанутся другим серверам
+            for chunk, sent, request in in_flight:
+                request.discard()
+                scheduler.fail(chunk)
+            if lost:
+                # Соединения зависшего сервера не переиспользуются
+                self.close_pool(address, port)
+
+
+def log(message):
+    print(f"[{datetime.now()}] {message}", file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Распределенный подсчет простых чисел без GUI')
+    parser.add_argument('start', type=int, help='Range start')
+    parser.add_argument('end', type=int, help='Range end (inclusive)')
+    parser.add_argument('--servers', default='',
+                        help='Comma-separated server list: host or host:port')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port for --servers entries without one and base port for --spawn')
+    parser.add_argument('--spawn', type=int, default=0, metavar='N',
+                        help='Start N local servers on consecutive ports and use them')
+    parser.add_argument('--server-workers', type=int, default=4,
+                        help='Worker threads per spawned server')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Local processes when no servers are given')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH,
+                        help='Minimum chunk size and server window size')
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR,
+                        help='Directory with journals of interrupted jobs')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='Do not record or resume completed chunks')
+    parser.add_argument('--stream', action='store_true',
+                        help='Print a JSON line for every completed chunk')
+    parser.add_argument('--primes', metavar='FILE',
+                        help='Write the primes themselves, one per line ("-" for stdout)')
+    parser.add_argument('--analytics', action='store_true',
+                        help='Also count twin/cousin/sexy pairs and find the maximal gap')
+    args = parser.parse_args()
+    if args.start < 1 or args.end < args.start:
+        parser.error('range must satisfy 1 <= start <= end')
+    if args.analytics and args.primes:
+        parser.error('--analytics cannot be combined with --primes')
+
+    def print_chunk(chunk, count, total, completed, processed, total_numbers):
+        print(json.dumps({"chunk": list(chunk), "count": count, "total": total,
+                          "processed": processed, "total_numbers": total_numbers}), flush=True)
+
+    coordinator = Coordinator(
+        batch_size=args.batch_size, use_journal=not args.no_journal,
+        journal_dir=args.journal_dir, on_result=print_chunk if args.stream else None,
+        on_error=log, on_notice=log)
+
+    servers = parse_servers(args.servers, args.port)
+    processes = []
+    interrupted = Event()
+    analytics = None
+    signal.signal(signal.SIGINT, lambda signum, frame: interrupted.set())
+    registry = None
+    began = time.monotonic()
+    try:
+        for i in range(args.spawn):
+            port = args.port + i
+            # Журнал сервера уходит в stderr, stdout остается для JSON
+            process = coordinator.spawn_server(port, args.server_workers, stdout=sys.stderr)
+            processes.append(process)
+            coordinator.wait_ready("localhost", port, process)
+            servers.append(("localhost", port))
+            log(f"Server started on localhost:{port}")
+
+        if servers:
+            registry = ServerRegistry(servers, on_change=lambda address, port, healthy: log(
+                f"Server {address}:{port} {'is up' if healthy else 'is not responding'}"))
+            registry.probe_all(wait_results=True)
+            registry.start()
+            coordinator.registry = registry
+
+        if args.primes:
+            output = sys.stdout if args.primes == '-' else open(args.primes, 'w')
+            total = 0
+            try:
+                for prime in coordinator.iter_primes(args.start, args.end, servers,
+                                                     cancelled=interrupted.is_set):
+                    output.write(f"{prime}\n")
+                    total += 1
+            except (OSError, protocol.ProtocolError) as e:
+                # Простые до сбоя уже записаны, но перечисление неполное
+                log(f"Enumeration failed: {e}")
+                total = None
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+            if interrupted.is_set():
+                total = None
+        elif args.analytics:
+            analytics = coordinator.analyze(args.start, args.end, servers, args.workers,
+                                            cancelled=interrupted.is_set)
+            total = analytics['count'] if analytics is not None else None
+        else:
+            total = coordinator.run(args.start, args.end, servers, args.workers,
+                                    cancelled=interrupted.is_set)
+    finally:
+        if registry is not None:
+            registry.stop()
+        coordinator.close()
+        for process in processes:
+            coordinator.stop_server(process)
+
+    summary = {
+        "start": args.start,
+        "end": args.end,
+        "primes": total,
+        "complete": total is not None,
+        "seconds": round(time.monotonic() - began, 3),
+        "servers": [f"{host}:{port}" for host, port in servers],
+    }
+    if analytics is not None:
+        summary["analytics"] = analytics
+    print(json.dumps(summary), file=sys.stderr if args.primes == '-' else sys.stdout, flush=True)
+    if total is None:
+        raise SystemExit(130 if interrupted.is_set() else 1)
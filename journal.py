@@ -0,0 +1,107 @@
+"""Журнал выполненных участков расчета
+
+Каждый посчитанный участок дописывается в файл строкой JSON и сразу
+сбрасывается на диск. Если расчет прерван (закрыто приложение, упали
+серверы), при повторном запуске того же диапазона журнал подсказывает
+планировщику, какие участки уже готовы и сколько в них простых
+(а для расчета со статистикой - и статистику участков).
+"""
+import json
+import os
+from threading import Lock
+
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".prime_numbers", "jobs")
+
+
+def journal_path(start, end, directory=JOURNAL_DIR, analytics=False):
+    suffix = "-analytics" if analytics else ""
+    return os.path.join(directory, f"{start}-{end}{suffix}.jsonl")
+
+
+class JobJournal:
+    """Журнал одного диапазона: заголовок и по строке на готовый участок"""
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.lock = Lock()
+        self.counts = {}
+        self.analytics = {}
+        complete = True
+        if os.path.exists(path):
+            complete = self.load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a" if self.counts else "w")
+        if not self.counts:
+            self.write({"start": start, "end": end})
+        elif not complete:
+            self.file.write("\n")
+
+    def load(self):
+        """Чтение готовых участков; False, если последняя строка не дописана"""
+        with open(self.path) as f:
+            text = f.read()
+        lines = text.splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            # Журнал оборвался до первого участка, начинаем заново
+            return True
+        if (header.get("start"), header.get("end")) != (self.start, self.end):
+            raise ValueError(f"Журнал {self.path} относится к другому диапазону")
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Последняя строка могла оборваться при аварийном завершении
+                continue
+            chunk = tuple(entry["chunk"])
+            self.counts[chunk] = entry["count"]
+            if "analytics" in entry:
+                self.analytics[chunk] = entry["analytics"]
+        return text.endswith("\n")
+
+    @property
+    def chunks(self):
+        return list(self.counts)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def processed(self):
+        return sum(chunk_end - chunk_start + 1 for chunk_start, chunk_end in self.counts)
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, chunk, count, analytics=None):
+        """Запись готового участка; после возврата он переживет сбой
+
+        analytics - числа статистики участка (RangeStats.to_ints).
+        """
+        entry = {"chunk": list(chunk), "count": count}
+        if analytics is not None:
+            entry["analytics"] = analytics
+        with self.lock:
+            self.counts[tuple(chunk)] = count
+            if analytics is not None:
+                self.analytics[tuple(chunk)] = analytics
+            self.write(entry)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def remove(self):
+        """Удаление журнала после успешного завершения расчета"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,203 @@
+"""Метрики сервера: счетчики, гистограммы задержек и HTTP-выдача
+
+Снимок метрик - обычный словарь, который сервер отдает в кадре STATS
+в виде JSON. Тот же словарь по HTTP отдается как JSON (/metrics.json)
+и в текстовом формате Prometheus (/metrics).
+"""
+import json
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# Границы корзин гистограммы длительности задач, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Окно, по которому считается текущая скорость, секунды
+RATE_WINDOW = 60
+PROMETHEUS_PREFIX = "prime_server"
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, как в Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'buckets': [[bound, count] for bound, count in zip(self.buckets, self.counts)],
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    """Потокобезопасный сбор метрик задач и вычислительных движков"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.job_latency = Histogram()
+        self.jobs = {'completed': 0, 'aborted': 0, 'failed': 0, 'rejected': 0}
+        self.queued = 0
+        self.running = 0
+        self.numbers_processed = 0
+        self.primes_found = 0
+        self.engine_seconds = {}
+        self.engine_numbers = {}
+        self.recent = deque()
+
+    def job_queued(self, limit=0):
+        """Постановка задачи в очередь; False, если в очереди уже limit задач"""
+        with self.lock:
+            if limit and self.queued >= limit:
+                return False
+            self.queued += 1
+            return True
+
+    def job_rejected(self):
+        with self.lock:
+            self.jobs['rejected'] += 1
+
+    def mean_job_seconds(self):
+        with self.lock:
+            if not self.job_latency.count:
+                return 0.0
+            return self.job_latency.sum / self.job_latency.count
+
+    def job_started(self):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+    def job_finished(self, outcome, seconds, numbers=0, primes=0):
+        """Учет завершенной задачи: outcome - completed, aborted или failed"""
+        now = time.monotonic()
+        with self.lock:
+            self.running -= 1
+            self.jobs[outcome] += 1
+            self.job_latency.observe(seconds)
+            self.numbers_processed += numbers
+            self.primes_found += primes
+            self.recent.append((now, numbers, primes))
+            self.trim(now)
+
+    def record_engine(self, engine, seconds, numbers):
+        """Время и объем работы одного вычислительного движка"""
+        with self.lock:
+            self.engine_seconds[engine] = self.engine_seconds.get(engine, 0.0) + seconds
+            self.engine_numbers[engine] = self.engine_numbers.get(engine, 0) + numbers
+
+    def trim(self, now):
+        while self.recent and now - self.recent[0][0] > RATE_WINDOW:
+            self.recent.popleft()
+
+    def snapshot(self):
+        with self.lock:
+            self.trim(time.monotonic())
+            numbers = sum(n for _, n, _ in self.recent)
+            primes = sum(p for _, _, p in self.recent)
+            return {
+                'jobs': dict(self.jobs),
+                'jobs_queued': self.queued,
+                'jobs_running': self.running,
+                'job_latency': self.job_latency.snapshot(),
+                'numbers_processed': self.numbers_processed,
+                'primes_found': self.primes_found,
+                'candidates_per_sec': numbers / RATE_WINDOW,
+                'primes_per_sec': primes / RATE_WINDOW,
+                'engine_seconds': dict(self.engine_seconds),
+                'engine_numbers': dict(self.engine_numbers),
+            }
+
+
+def prometheus_text(stats):
+    """Снимок статистики сервера в текстовом формате Prometheus"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        """samples - значение или список пар (метки, значение)"""
+        full = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# HELP {full} {help_text}")
+        lines.append(f"# TYPE {full} {kind}")
+        if not isinstance(samples, list):
+            samples = [("", samples)]
+        for labels, value in samples:
+            lines.append(f"{full}{{{labels}}} {value}" if labels else f"{full} {value}")
+
+    metric("uptime_seconds", "gauge", "Seconds since server start", stats['uptime'])
+    metric("active_connections", "gauge", "Open client connections",
+           stats['active_connections'])
+    metric("cpu_percent", "gauge", "Host CPU load", stats['cpu_load'])
+    metric("memory_percent", "gauge", "Host memory usage", stats['memory_usage'])
+    metric("numbers_processed_total", "counter", "Numbers checked by finished jobs",
+           stats['numbers_processed'])
+    metric("primes_found_total", "counter", "Primes found by finished jobs",
+           stats['primes_found'])
+    metric("jobs_total", "counter", "Finished jobs by outcome",
+           [(f'outcome="{outcome}"', count) for outcome, count in stats['jobs'].items()])
+    metric("jobs_queued", "gauge", "Jobs waiting for an executor thread", stats['jobs_queued'])
+    metric("jobs_running", "gauge", "Jobs being computed", stats['jobs_running'])
+    metric("engine_seconds_total", "counter", "Compute time by engine",
+           [(f'engine="{engine}"', seconds)
+            for engine, seconds in stats['engine_seconds'].items()])
+    metric("engine_numbers_total", "counter", "Numbers handled by engine",
+           [(f'engine="{engine}"', numbers)
+            for engine, numbers in stats['engine_numbers'].items()])
+    if 'cache_hits' in stats:
+        metric("cache_hits_total", "counter", "Block cache hits", stats['cache_hits'])
+        metric("cache_misses_total", "counter", "Block cache misses", stats['cache_misses'])
+        metric("cache_hit_ratio", "gauge", "Block cache hit ratio", stats['cache_hit_ratio'])
+
+    latency = stats['job_latency']
+    full = f"{PROMETHEUS_PREFIX}_job_duration_seconds"
+    lines.append(f"# HELP {full} Time from request arrival to result")
+    lines.append(f"# TYPE {full} histogram")
+    for bound, count in latency['buckets']:
+        lines.append(f'{full}_bucket{{le="{bound}"}} {count}')
+    lines.append(f'{full}_bucket{{le="+Inf"}} {latency["count"]}')
+    lines.append(f"{full}_sum {latency['sum']}")
+    lines.append(f"{full}_count {latency['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(collect, host="0.0.0.0", port=9100):
+    """Запуск HTTP-сервера метрик в фоновом потоке
+
+    collect() возвращает текущий снимок статистики сервера.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body = prometheus_text(collect()).encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body = json.dumps(collect()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,120 @@
+"""Профилирование отдельных задач сервера
+
+Профиль включается только для выбранных задач: для остальных вместо
+замеров используются пустые контексты, и накладные расходы сводятся
+к одной проверке на None.
+"""
+import cProfile
+import json
+import os
+import pstats
+import time
+from contextlib import contextmanager, nullcontext
+
+# Сколько самых затратных функций попадает в отчет
+PROFILE_TOP = 15
+
+
+class JobProfile:
+    """Время задачи по фазам (расчет, отправка, ожидание блокировок) и горячие функции
+
+    Фазы могут быть вложенными: время вложенной фазы не входит во внешнюю,
+    поэтому отправка прогресса изнутри расчета не завышает время расчета.
+    Методы вызываются из потока задачи.
+    """
+
+    def __init__(self, trace=True):
+        self.phases = {}
+        self.stack = []
+        self.started = None
+        self.elapsed = 0.0
+        self.profiler = cProfile.Profile() if trace else None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Другой профилировщик уже активен в интерпретаторе
+                self.profiler = None
+
+    def stop(self):
+        if self.started is None:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.elapsed = time.perf_counter() - self.started
+        self.started = None
+
+    def add(self, name, seconds, calls=1):
+        entry = self.phases.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    @contextmanager
+    def phase(self, name):
+        frame = [time.perf_counter(), 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            if self.stack:
+                self.stack[-1][1] += elapsed
+            self.add(name, elapsed - frame[1])
+
+    @contextmanager
+    def locked(self, lock, name="lock_wait"):
+        """Захват блокировки с учетом времени ожидания"""
+        began = time.perf_counter()
+        with lock:
+            waited = time.perf_counter() - began
+            if self.stack:
+                self.stack[-1][1] += waited
+            self.add(name, waited)
+            yield
+
+    def hotspots(self, top=PROFILE_TOP):
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        return [
+            {
+                'function': f"{os.path.basename(filename)}:{line}({name})",
+                'calls': calls,
+                'own_seconds': own,
+                'cumulative_seconds': cumulative,
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in rows[:top]
+        ]
+
+    def report(self, **details):
+        """Отчет для клиента или файла; details - описание задачи"""
+        phases = {name: {'seconds': seconds, 'calls': calls}
+                  for name, (seconds, calls) in self.phases.items()}
+        return {**details, 'total_seconds': self.elapsed, 'phases': phases,
+                'hotspots': self.hotspots()}
+
+    def dump(self, path, report):
+        """Запись отчета в path.json и сырых данных cProfile в path.prof"""
+        with open(path + ".json", "w") as f:
+            json.dump(report, f, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(path + ".prof")
+
+
+def phase(profile, name):
+    """Контекст замера фазы; без профиля ничего не делает"""
+    if profile is None:
+        return nullcontext()
+    return profile.phase(name)
+
+
+def locked(profile, lock, name="lock_wait"):
+    """Захват блокировки, с профилем - с замером ожидания"""
+    if profile is None:
+        return lock
+    return profile.locked(lock, name)
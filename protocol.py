@@ -0,0 +1,226 @@
+"""Бинарный протокол обмена между клиентом и сервером
+
+Каждое сообщение - кадр: заголовок (версия, тип, идентификатор запроса,
+длина полезной нагрузки) и сама нагрузка. Идентификатор позволяет вести
+несколько запросов в одном соединении: ответы несут id своего запроса. Целые числа произвольной величины передаются как
+беззнаковые big-endian байты с двухбайтовым префиксом длины.
+
+Простые числа при перечислении идут кадрами PRIMES: первое число кадра
+целиком, остальные - разностями с предыдущим в формате varint
+(разности между нечетными простыми четные и передаются деленными на 2).
+
+Запрос ANALYZE считает то же, что REQUEST, но кадр RESULT после количества
+несет числа статистики участка (analytics.RangeStats.to_ints).
+
+Перегруженный сервер отвечает на запрос кадром BUSY с подсказкой, через
+сколько миллисекунд стоит повторить запрос.
+"""
+import json
+import struct
+
+PROTOCOL_VERSION = 2
+
+# Типы кадров
+REQUEST = 1
+PROGRESS = 2
+RESULT = 3
+ERROR = 4
+STATS = 5
+CANCEL = 6
+PROFILE = 7
+ENUMERATE = 8
+PRIMES = 9
+BUSY = 10
+ANALYZE = 11
+
+HEADER = struct.Struct("!BBII")
+INT_LENGTH = struct.Struct("!H")
+MAX_PAYLOAD = 16 * 1024 * 1024
+RECV_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    """Нарушение формата кадра или несовместимая версия протокола"""
+
+
+class ServerBusy(ProtocolError):
+    """Сервер перегружен и не принял запрос; retry_after - пауза перед повтором, секунды"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Сервер перегружен, повтор через {retry_after:.1f} с")
+        self.retry_after = retry_after
+
+
+def encode_int(n):
+    if n < 0:
+        raise ProtocolError(f"Отрицательное число не поддерживается: {n}")
+    raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return INT_LENGTH.pack(len(raw)) + raw
+
+
+def decode_ints(payload):
+    """Разбор последовательности чисел из нагрузки кадра"""
+    values = []
+    offset = 0
+    while offset < len(payload):
+        if offset + INT_LENGTH.size > len(payload):
+            raise ProtocolError("Обрезанное число в кадре")
+        (length,) = INT_LENGTH.unpack_from(payload, offset)
+        offset += INT_LENGTH.size
+        if offset + length > len(payload):
+            raise ProtocolError("Обрезанное число в кадре")
+        values.append(int.from_bytes(payload[offset:offset + length], "big"))
+        offset += length
+    return values
+
+
+def encode_frame(frame_type, payload=b"", request_id=0):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, request_id, len(payload)) + payload
+
+
+def request_frame(start, end, batch_size, request_id=0):
+    payload = encode_int(start) + encode_int(end) + encode_int(batch_size)
+    return encode_frame(REQUEST, payload, request_id)
+
+
+def progress_frame(num, count, request_id=0):
+    return encode_frame(PROGRESS, encode_int(num) + encode_int(count), request_id)
+
+
+def result_frame(count, request_id=0, analytics=None):
+    """Итог запроса; analytics - числа статистики для ответа на ANALYZE"""
+    payload = encode_int(count)
+    if analytics is not None:
+        payload += b"".join(encode_int(value) for value in analytics)
+    return encode_frame(RESULT, payload, request_id)
+
+
+def decode_result(payload):
+    """(количество, числа статистики или None) из кадра RESULT"""
+    values = decode_ints(payload)
+    return values[0], values[1:] or None
+
+
+def error_frame(message, request_id=0):
+    return encode_frame(ERROR, message.encode(), request_id)
+
+
+def stats_frame(stats=None, request_id=0):
+    """Кадр статистики: пустой - запрос, с JSON - ответ сервера"""
+    if stats is None:
+        return encode_frame(STATS, request_id=request_id)
+    return encode_frame(STATS, json.dumps(stats).encode(), request_id)
+
+
+def profile_frame(start, end, batch_size, request_id=0):
+    """Запрос с профилированием: перед результатом сервер пришлет кадр PROFILE с JSON"""
+    payload = encode_int(start) + encode_int(end) + encode_int(batch_size)
+    return encode_frame(PROFILE, payload, request_id)
+
+
+def profile_report_frame(report, request_id=0):
+    return encode_frame(PROFILE, json.dumps(report).encode(), request_id)
+
+
+def analyze_frame(start, end, batch_size, request_id=0):
+    """Запрос количества простых вместе со статистикой по ним"""
+    payload = encode_int(start) + encode_int(end) + encode_int(batch_size)
+    return encode_frame(ANALYZE, payload, request_id)
+
+
+def enumerate_frame(start, end, batch_size, request_id=0):
+    """Запрос самих простых: сервер отвечает кадрами PRIMES и RESULT с их количеством"""
+    payload = encode_int(start) + encode_int(end) + encode_int(batch_size)
+    return encode_frame(ENUMERATE, payload, request_id)
+
+
+def primes_frame(primes, request_id=0):
+    """Кадр с непустой возрастающей последовательностью простых"""
+    payload = bytearray(encode_int(primes[0]))
+    prev = primes[0]
+    for prime in primes[1:]:
+        gap = prime - prev if prev == 2 else (prime - prev) >> 1
+        while gap >= 0x80:
+            payload.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        payload.append(gap)
+        prev = prime
+    return encode_frame(PRIMES, bytes(payload), request_id)
+
+
+def decode_primes(payload):
+    """Разбор кадра PRIMES в список простых"""
+    if len(payload) < INT_LENGTH.size:
+        raise ProtocolError("Пустой кадр PRIMES")
+    (length,) = INT_LENGTH.unpack_from(payload)
+    offset = INT_LENGTH.size + length
+    if offset > len(payload):
+        raise ProtocolError("Обрезанное число в кадре")
+    prev = int.from_bytes(payload[INT_LENGTH.size:offset], "big")
+    primes = [prev]
+    gap = shift = 0
+    for byte in payload[offset:]:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        prev += gap if prev == 2 else gap << 1
+        primes.append(prev)
+        gap = shift = 0
+    if shift:
+        raise ProtocolError("Обрезанная разность в кадре PRIMES")
+    return primes
+
+
+def busy_frame(retry_after, request_id=0):
+    """Отказ в приеме запроса; retry_after - через сколько секунд повторить"""
+    return encode_frame(BUSY, encode_int(round(retry_after * 1000)), request_id)
+
+
+def decode_busy(payload):
+    return decode_ints(payload)[0] / 1000
+
+
+def cancel_frame(request_id):
+    """Отмена ранее отправленного запроса с этим id"""
+    return encode_frame(CANCEL, request_id=request_id)
+
+
+class FrameReader:
+    """Буферизованное чтение кадров из сокета при любых границах пакетов"""
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read_frame(self):
+        """Возвращает (тип, id запроса, нагрузка) или None, если соединение закрыто"""
+        while True:
+            frame = self.parse()
+            if frame is not None:
+                return frame
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                if self.buffer:
+                    raise ProtocolError("Соединение закрыто посреди кадра")
+                return None
+            self.feed(data)
+
+    def feed(self, data):
+        """Добавление принятых байтов; используется и без сокета (asyncio)"""
+        self.buffer += data
+
+    def parse(self):
+        if len(self.buffer) < HEADER.size:
+            return None
+        version, frame_type, request_id, length = HEADER.unpack_from(self.buffer)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Неподдерживаемая версия протокола: {version}")
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Слишком большой кадр: {length} байт")
+        total = HEADER.size + length
+        if len(self.buffer) < total:
+            return None
+        payload = bytes(self.buffer[HEADER.size:total])
+        del self.buffer[:total]
+        return frame_type, request_id, payload
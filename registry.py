@@ -0,0 +1,201 @@
+"""Реестр серверов с фоновой проверкой состояния
+
+Все настроенные серверы опрашиваются кадром STATS одновременно, каждый
+в своем потоке и с коротким таймаутом, поэтому недоступный хост не
+задерживает ни опрос остальных, ни интерфейс. По ответам реестр знает,
+какие серверы живы и насколько они загружены, и предлагает новую работу
+наименее загруженным.
+"""
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Event, Lock, Thread
+
+import protocol
+
+# Период опроса серверов, секунды
+PROBE_INTERVAL = 2
+# Таймаут одного опроса (соединение и ответ), секунды
+PROBE_TIMEOUT = 1
+# Сколько опросов подряд должно не пройти, чтобы сервер считался недоступным
+FAILURES_BEFORE_DOWN = 2
+# Вес нового замера задержки в скользящем среднем
+LATENCY_SMOOTHING = 0.3
+# Нагрузка (задач на рабочий поток плюс доля занятого CPU), выше которой
+# сервер не получает новых участков, пока есть менее загруженные
+OVERLOAD = 2.0
+
+
+class ServerState:
+    """Последнее известное состояние одного сервера"""
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.healthy = None  # None - еще не опрошен
+        self.failures = 0
+        self.latency = None
+        self.stats = {}
+        self.error = None
+        self.last_seen = None
+        self.probing = False
+
+    @property
+    def load(self):
+        """Оценка загрузки: очередь задач на поток сервера и загрузка CPU
+
+        Сервер с заполненной очередью все равно отклонит новую задачу.
+        """
+        max_queue = self.stats.get('max_queue')
+        if max_queue and self.stats.get('jobs_queued', 0) >= max_queue:
+            return float('inf')
+        jobs = self.stats.get('jobs_queued', 0) + self.stats.get('jobs_running', 0)
+        workers = self.stats.get('workers') or 1
+        return jobs / workers + self.stats.get('cpu_load', 0) / 100
+
+    def snapshot(self):
+        return {
+            'address': self.address,
+            'port': self.port,
+            'healthy': self.healthy,
+            'latency': self.latency,
+            'load': self.load,
+            'cpu_load': self.stats.get('cpu_load'),
+            'active_connections': self.stats.get('active_connections'),
+            'jobs_queued': self.stats.get('jobs_queued'),
+            'jobs_running': self.stats.get('jobs_running'),
+            'error': self.error,
+            'last_seen': self.last_seen,
+        }
+
+
+def probe(address, port, timeout=PROBE_TIMEOUT):
+    """Один запрос статистики по отдельному соединению: (задержка, статистика)"""
+    began = time.monotonic()
+    with socket.create_connection((address, port), timeout=timeout) as sock:
+        sock.settimeout(max(0.01, timeout - (time.monotonic() - began)))
+        sock.sendall(protocol.stats_frame())
+        frame = protocol.FrameReader(sock).read_frame()
+    if frame is None:
+        raise ConnectionError("Сервер закрыл соединение")
+    frame_type, _, payload = frame
+    if frame_type != protocol.STATS:
+        raise protocol.ProtocolError(f"Неожиданный кадр от сервера: тип {frame_type}")
+    return time.monotonic() - began, json.loads(payload)
+
+
+class ServerRegistry:
+    """Набор серверов, опрашиваемых в фоне
+
+    on_change(address, port, healthy) вызывается из потока опроса,
+    когда сервер становится доступным или перестает отвечать.
+    """
+
+    def __init__(self, servers=(), interval=PROBE_INTERVAL, timeout=PROBE_TIMEOUT,
+                 on_change=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.on_change = on_change or (lambda address, port, healthy: None)
+        self.states = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=32)
+        self.set_servers(servers)
+
+    def set_servers(self, servers):
+        """Замена списка серверов; состояние оставшихся сохраняется"""
+        servers = list(dict.fromkeys(servers))
+        with self.lock:
+            self.states = {key: self.states.get(key) or ServerState(*key) for key in servers}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.probe_all()
+            self.stopped.wait(self.interval)
+
+    def probe_all(self, wait_results=False):
+        """Опрос всех серверов, еще не ожидающих ответа
+
+        С wait_results возврат после ответов (или таймаутов) всех опросов.
+        """
+        with self.lock:
+            states = [state for state in self.states.values() if not state.probing]
+            for state in states:
+                state.probing = True
+        futures = []
+        for state in states:
+            try:
+                futures.append(self.executor.submit(self.check, state))
+            except RuntimeError:
+                return  # реестр остановлен
+        if wait_results:
+            wait(futures, timeout=self.timeout * 2)
+
+    def check(self, state):
+        try:
+            latency, stats = probe(state.address, state.port, self.timeout)
+        except Exception as e:
+            with self.lock:
+                state.probing = False
+                state.failures += 1
+                state.error = str(e)[:100]
+                changed = state.healthy is not False and (
+                    state.failures >= FAILURES_BEFORE_DOWN or state.healthy is None)
+                if changed:
+                    state.healthy = False
+        else:
+            with self.lock:
+                state.probing = False
+                state.failures = 0
+                state.error = None
+                state.stats = stats
+                state.last_seen = time.time()
+                state.latency = latency if state.latency is None else (
+                    LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * state.latency)
+                changed = state.healthy is not True
+                state.healthy = True
+        if changed:
+            self.on_change(state.address, state.port, state.healthy)
+
+    def is_healthy(self, address, port):
+        with self.lock:
+            state = self.states.get((address, port))
+            return state is not None and state.healthy is True
+
+    def select(self, servers=None):
+        """Доступные серверы (из servers, если задан) от наименее загруженного"""
+        with self.lock:
+            states = [state for key, state in self.states.items()
+                      if state.healthy and (servers is None or key in servers)]
+            states.sort(key=lambda state: (state.load, state.latency))
+            return [(state.address, state.port) for state in states]
+
+    def accepts_work(self, address, port):
+        """Стоит ли давать серверу новый участок
+
+        Перегруженный сервер пропускает очередь, пока есть доступный сервер
+        с нагрузкой ниже OVERLOAD; если перегружены все, работу получают все.
+        """
+        with self.lock:
+            state = self.states.get((address, port))
+            if state is None or not state.healthy:
+                return False
+            if state.load < OVERLOAD:
+                return True
+            return not any(other.healthy and other.load < OVERLOAD
+                           for other in self.states.values())
+
+    def snapshot(self):
+        with self.lock:
+            return [state.snapshot() for state in self.states.values()]
@@ -0,0 +1,120 @@
+import time
+from collections import deque
+from threading import Lock
+
+# Сколько участков в среднем приходится на один сервер в начале расчета
+CHUNKS_PER_WORKER = 16
+# Желаемая длительность обработки одного участка сервером, секунды
+TARGET_CHUNK_SECONDS = 2.0
+# Вес нового измерения в скользящей оценке производительности
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class ChunkScheduler:
+    """Динамическая выдача участков диапазона серверам
+
+    Диапазон режется на участки по мере запросов: каждый сервер получает
+    новый участок, как только сообщает о завершении предыдущего. Размер
+    участка подбирается по измеренной скорости сервера так, чтобы он
+    обрабатывался примерно за TARGET_CHUNK_SECONDS, и уменьшается к концу
+    диапазона, чтобы медленный сервер не задерживал весь расчет.
+
+    completed - уже посчитанные участки (например, из журнала прерванного
+    расчета): выдаются только промежутки между ними.
+    """
+
+    def __init__(self, start, end, workers, min_chunk=1000, max_chunk=None,
+                 target_seconds=TARGET_CHUNK_SECONDS, completed=()):
+        self.start = start
+        self.end = end
+        self.gaps = deque(uncovered(start, end, completed))
+        self.queued = sum(gap_end - gap_start + 1 for gap_start, gap_end in self.gaps)
+        total = self.queued
+        self.workers = max(1, workers)
+        self.min_chunk = max(1, min_chunk)
+        self.max_chunk = max_chunk or max(self.min_chunk, total // self.workers)
+        self.target_seconds = target_seconds
+        self.initial_chunk = self.clamp(total // (self.workers * CHUNKS_PER_WORKER))
+
+        # Текущий промежуток: участки режутся от next_start до gap_end
+        self.next_start, self.gap_end = end + 1, end
+        self.returned = deque()
+        self.in_flight = {}
+        self.throughput = {}
+        self.processed = (end - start + 1) - total
+        self.lock = Lock()
+
+    def clamp(self, size):
+        return max(self.min_chunk, min(self.max_chunk, size))
+
+    def chunk_size(self, worker):
+        """Размер следующего участка для сервера по его скорости"""
+        rate = self.throughput.get(worker)
+        size = self.initial_chunk if rate is None else int(rate * self.target_seconds)
+        # Ближе к концу участки мельче, чтобы хвост делился между всеми серверами
+        remaining = self.gap_end - self.next_start + 1 + self.queued
+        size = min(size, max(self.min_chunk, remaining // (2 * self.workers)))
+        return self.clamp(size)
+
+    def next_chunk(self, worker):
+        """Выдача очередного участка серверу или None, если работы не осталось"""
+        with self.lock:
+            if self.next_start > self.gap_end and self.gaps:
+                self.next_start, self.gap_end = self.gaps.popleft()
+                self.queued -= self.gap_end - self.next_start + 1
+            if self.returned:
+                chunk = self.returned.popleft()
+            elif self.next_start <= self.gap_end:
+                chunk_start = self.next_start
+                chunk_end = min(chunk_start + self.chunk_size(worker) - 1, self.gap_end)
+                self.next_start = chunk_end + 1
+                chunk = (chunk_start, chunk_end)
+            else:
+                return None
+            self.in_flight[chunk] = (worker, time.monotonic())
+            return chunk
+
+    def complete(self, chunk, elapsed=None):
+        """Учет завершенного участка и обновление оценки скорости сервера
+
+        elapsed задается, если участок ждал в очереди сервера и время
+        с момента выдачи не отражает скорость обработки.
+        """
+        with self.lock:
+            worker, started = self.in_flight.pop(chunk)
+            size = chunk[1] - chunk[0] + 1
+            self.processed += size
+            if elapsed is None:
+                elapsed = time.monotonic() - started
+            elapsed = max(elapsed, 1e-3)
+            rate = size / elapsed
+            previous = self.throughput.get(worker)
+            if previous is not None:
+                rate = previous + THROUGHPUT_SMOOTHING * (rate - previous)
+            self.throughput[worker] = rate
+
+    def fail(self, chunk):
+        """Возврат участка в очередь после ошибки сервера"""
+        with self.lock:
+            self.in_flight.pop(chunk, None)
+            self.returned.append(chunk)
+
+    def finished(self):
+        with self.lock:
+            return (self.next_start > self.gap_end and not self.gaps
+                    and not self.returned and not self.in_flight)
+
+
+def uncovered(start, end, chunks):
+    """Промежутки [start, end], не покрытые участками chunks"""
+    gaps = []
+    cursor = start
+    for chunk_start, chunk_end in sorted(chunks):
+        if chunk_start > cursor:
+            gaps.append((cursor, min(chunk_start - 1, end)))
+        cursor = max(cursor, chunk_end + 1)
+        if cursor > end:
+            break
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
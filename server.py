@@ -1,137 +1,1400 @@
 import socket
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
 import math
+import bisect
+from itertools import compress
 import argparse
 from datetime import datetime
 import time
 import psutil
 import threading
+import multiprocessing
+import os
+import mmap
+import array
+import struct
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import protocol
+from analytics import RangeStats
+from metrics import Metrics, serve_metrics
+from profiler import JobProfile, phase, locked
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# Сегмент решета подбирается под L2-кэш: один байт на нечетное число
+SEGMENT_BYTES = 1 << 18
+# Решето применяется, если ширина диапазона заметно больше sqrt(end)
+SIEVE_DENSITY = 8
+# Выше этой границы таблица базовых простых слишком велика для памяти
+SIEVE_MAX_END = 10**14
+# Разбиение диапазона для пула процессов: частей на процесс и минимальный размер части
+PROCESS_CHUNKS_PER_WORKER = 4
+PROCESS_MIN_CHUNK = 10000
+# Минимальный интервал между кадрами прогресса, секунды
+PROGRESS_INTERVAL = 0.5
+# Число одновременно отменяемых задач в пуле процессов (ячейки общей памяти)
+CANCEL_SLOTS = 1024
+# Постоянное соединение без запросов закрывается через столько секунд
+IDLE_TIMEOUT = 300
+# Простых в одном кадре PRIMES при перечислении
+PRIMES_PER_FRAME = 8192
+# Объем неотправленных данных соединения asyncio, после которого поток расчета ждет клиента
+ASYNC_WRITE_LIMIT = 1 << 20
+# Ограничения приема работы: задач в очереди на рабочий поток, задач одного
+# клиента (адреса) и соединений с задачами (запросы статуса не ограничиваются)
+QUEUE_PER_WORKER = 4
+MAX_CLIENT_JOBS = 16
+MAX_CONNECTIONS = 64
+# Границы подсказки клиенту, через сколько секунд повторить отклоненный запрос
+RETRY_AFTER_MIN = 0.1
+RETRY_AFTER_MAX = 30
+
+# Оценки стоимости движков для выбора между решетом и Lucy_Hedgehog, нс.
+# Замеры (один поток; решето - участок шириной 5e6 у end):
+#   end    решето, нс/число   pi(end) numpy   pi(end) python
+#   1e7          2.7              0.004 с         0.01 с
+#   1e8          3.6              0.013 с         0.06 с
+#   1e9          6.4              0.049 с         0.32 с
+#   1e10        15.2              0.27 с          2.3 с
+#   1e11        46.7              1.08 с         14.4 с
+#   1e12       169.5              4.57 с
+#   1e13       330.0             24.2 с
+# Решето на каждом сегменте перебирает все простые до sqrt(end), поэтому
+# цена числа растет с end; pi(n) стоит около k * n^(3/4) плюс накладные
+# расходы numpy. Точка равенства по этим замерам: ширина ~7e6 при end=1e8,
+# ~4.6e7 при end=1e11.
+SIEVE_NS_PER_NUMBER = 2.5
+SIEVE_NS_PER_PRIME = 900  # на каждое простое до sqrt(end) в каждом сегменте
+LUCY_NS_NUMPY = 5.5
+LUCY_OVERHEAD_NS_NUMPY = 5 * 10**6
+LUCY_NS_PYTHON = 70
+# Таблицы занимают O(sqrt(end)) памяти
+LUCY_MAX_END_NUMPY = 10**14
+LUCY_MAX_END_PYTHON = 10**12
+# Как часто (в простых числах) проверять отмену во время подсчета pi(x)
+LUCY_PROGRESS_STEP = 1000
+
+# Проверка простоты: малые простые для отсева через НОД и минимальные наборы
+# оснований Миллера-Рабина, детерминированные ниже соответствующей границы
+SMALL_PRIMES_LIMIT = 300
+MR_BASES = [
+    (2047, (2,)),
+    (1373653, (2, 3)),
+    (25326001, (2, 3, 5)),
+    (3215031751, (2, 3, 5, 7)),
+    (2152302898747, (2, 3, 5, 7, 11)),
+    (3474749660383, (2, 3, 5, 7, 11, 13)),
+    (2 ** 64, (2, 325, 9375, 28178, 450775, 9780504, 1795265022)),
+]
+MR_BASES_BOUND = 2 ** 64
+# Окна разреженного подсчета: минимальный размер и граница просеивания малыми
+# простыми; для чисел выше 2^64 строгий тест дороже, и просеивать выгодно глубже
+WINDOW_MIN_SIZE = 1 << 14
+WINDOW_SIEVE_LIMIT = 1 << 10
+WINDOW_SIEVE_LIMIT_LARGE = 1 << 15
+# Векторизованной проверке нужны крупные окна, чтобы накладные расходы NumPy окупались
+NUMPY_WINDOW_MIN_SIZE = 1 << 18
+ENGINE_CALIBRATION_START = 10**18
+UINT32_MASK = np.uint64(0xFFFFFFFF) if np is not None else None
+UINT32_SHIFT = np.uint64(32) if np is not None else None
+
+# Кэш результатов: ширина выровненного блока и оценка памяти на одну запись
+CACHE_BLOCK_SIZE = 1 << 20
+CACHE_ENTRY_BYTES = 128
+# Как часто (в блоках) проверять отмену при разбиении диапазона на блоки
+CACHE_PLAN_CHECK_STEP = 4096
+# Шаг контрольных точек pi(x) в индексе на диске
+INDEX_STEP = 10**6
+INDEX_MAGIC = b"PRIX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIQQ")
+
+SMALL_PRIMES_SET = frozenset(
+    p for p in range(2, SMALL_PRIMES_LIMIT) if all(p % q for q in range(2, math.isqrt(p) + 1))
+)
+SMALL_PRIMES_PRODUCT = math.prod(SMALL_PRIMES_SET)
+
+_base_primes_cache = [2, 3, 5, 7]
+_base_primes_limit = 10
+_base_primes_lock = threading.Lock()
+# Флаги отмены, общие для сервера и процессов пула
+_cancel_flags = None
+
+
+class JobAborted(Exception):
+    """Расчет прерван: клиент отключился или отказался от результата"""
+
+
+def init_worker(cancel_flags):
+    """Инициализация процесса пула: доступ к общим флагам отмены"""
+    global _cancel_flags
+    _cancel_flags = cancel_flags
+
+
+def slot_progress(slot):
+    """progress для задачи пула: False, когда взведен флаг отмены ячейки slot"""
+    if slot is None or _cancel_flags is None:
+        return None
+    return lambda num, count: not _cancel_flags[slot]
+
+
+def count_range_task(start, end, batch_size, slot=None, engine="python"):
+    """Задача пула процессов: подсчет с проверкой флага отмены своей ячейки"""
+    return count_range(start, end, batch_size, slot_progress(slot), engine)
+
+
+def timed_range_task(start, end, batch_size, slot=None, engine="python"):
+    """Задача пула с замером: (количество, затраченное время процесса)"""
+    began = time.perf_counter()
+    count = count_range_task(start, end, batch_size, slot, engine)
+    return count, time.perf_counter() - began
+
+
+def analyze_range_task(start, end, batch_size, slot=None):
+    """Задача пула процессов: статистика части диапазона с проверкой флага отмены"""
+    return analyze_range(start, end, batch_size, slot_progress(slot))
+
+
+def base_primes(limit):
+    """Кэшированная таблица простых чисел до limit включительно"""
+    global _base_primes_cache, _base_primes_limit
+    with _base_primes_lock:
+        if limit > _base_primes_limit:
+            # Расширяем с запасом, чтобы не пересчитывать на каждом запросе
+            new_limit = max(limit, _base_primes_limit * 2)
+            sieve = bytearray([1]) * (new_limit + 1)
+            sieve[0] = sieve[1] = 0
+            for p in range(2, math.isqrt(new_limit) + 1):
+                if sieve[p]:
+                    sieve[p * p::p] = bytes(len(range(p * p, new_limit + 1, p)))
+            _base_primes_cache = [i for i, flag in enumerate(sieve) if flag]
+            _base_primes_limit = new_limit
+        primes = _base_primes_cache
+    if primes[-1] <= limit:
+        return primes
+    return primes[:bisect.bisect_right(primes, limit)]
+
+
+def use_sieve(start, end):
+    """Выбор сегментированного решета для плотных диапазонов"""
+    if end > SIEVE_MAX_END or end < 2:
+        return False
+    return end - start + 1 >= SIEVE_DENSITY * math.isqrt(end)
+
+
+def sieve_count(start, end, progress=None):
+    """Подсчет простых сегментированным решетом Эратосфена
+
+    Сегмент хранит только нечетные числа. progress(num, count) вызывается
+    после каждого сегмента; если он возвращает False, подсчет прерывается
+    исключением JobAborted.
+    """
+    start = max(start, 2)
+    if start > end:
+        return 0
+
+    count = 1 if start <= 2 <= end else 0
+    primes = base_primes(math.isqrt(end))[1:]
+    span = 2 * SEGMENT_BYTES
+
+    lo = start | 1
+    while lo <= end:
+        hi = min(lo + span - 1, end)
+        segment = sieve_window(lo, hi, primes)
+        count += segment.count(1)
+        if progress is not None and progress(hi, count) is False:
+            raise JobAborted()
+        lo += 2 * len(segment)
+
+    return count
+
+
+def sieve_window(lo, hi, primes):
+    """Флаги нечетных чисел lo, lo + 2, ..., hi (lo нечетно), не делящихся на primes
+
+    primes - нечетные простые по возрастанию; само простое не вычеркивается.
+    """
+    size = (hi - lo) // 2 + 1
+    segment = bytearray([1]) * size
+    if lo == 1:
+        segment[0] = 0
+    for p in primes:
+        first = p * p
+        if first > hi:
+            break
+        if first < lo:
+            first = ((lo + p - 1) // p) * p
+            if first % 2 == 0:
+                first += p
+        idx = (first - lo) // 2
+        if idx < size:
+            segment[idx::p] = bytes((size - 1 - idx) // p + 1)
+    return segment
+
+
+def sieve_cost(start, end):
+    """Оценка времени sieve_count(start, end), нс"""
+    width = end - start + 1
+    segments = width // (2 * SEGMENT_BYTES) + 1
+    root = max(math.isqrt(end), 3)
+    base_primes_count = root / math.log(root)
+    return width * SIEVE_NS_PER_NUMBER + segments * base_primes_count * SIEVE_NS_PER_PRIME
+
+
+def lucy_cost(start, end):
+    """Оценка времени prime_pi(end) - prime_pi(start - 1), нс"""
+    if np is not None:
+        per_call, overhead = LUCY_NS_NUMPY, LUCY_OVERHEAD_NS_NUMPY
+    else:
+        per_call, overhead = LUCY_NS_PYTHON, 0
+    return sum(per_call * n ** 0.75 + overhead for n in (end, start - 1) if n >= 2)
+
+
+def use_lucy(start, end):
+    """Выбор сублинейного подсчета pi(end) - pi(start - 1) для широких диапазонов"""
+    max_end = LUCY_MAX_END_NUMPY if np is not None else LUCY_MAX_END_PYTHON
+    if end > max_end or end < 2:
+        return False
+    return lucy_cost(start, end) < sieve_cost(start, end)
+
+
+def prime_pi(n, progress=None):
+    """Количество простых <= n методом Lucy_Hedgehog за O(n^(3/4))
+
+    small[v] и large[i] хранят количество чисел <= v и <= n // i, не
+    вычеркнутых простыми меньше текущего p. progress(p, 0) вызывается
+    для проверки отмены.
+    """
+    if n < 2:
+        return 0
+    if np is not None and n <= LUCY_MAX_END_NUMPY:
+        return _prime_pi_numpy(n, progress)
+    return _prime_pi_python(n, progress)
+
+
+def _prime_pi_python(n, progress):
+    r = math.isqrt(n)
+    small = list(range(-1, r))
+    large = [0] + [n // i - 1 for i in range(1, r + 1)]
+    primes_seen = 0
+    for p in range(2, r + 1):
+        sp = small[p - 1]
+        if small[p] == sp:
+            continue
+        primes_seen += 1
+        if progress is not None and primes_seen % LUCY_PROGRESS_STEP == 0:
+            if progress(p, 0) is False:
+                raise JobAborted()
+
+        p2 = p * p
+        lim = min(r, n // p2)
+        k = min(lim, r // p)
+        # Возрастающий i читает large[i * p] до его обновления
+        for i in range(1, k + 1):
+            large[i] -= large[i * p] - sp
+        for i in range(k + 1, lim + 1):
+            large[i] -= small[n // (i * p)] - sp
+        # Убывающий v читает small[v // p] до его обновления
+        for v in range(r, p2 - 1, -1):
+            small[v] -= small[v // p] - sp
+    return large[1]
+
+
+def _prime_pi_numpy(n, progress):
+    r = math.isqrt(n)
+    values = np.arange(r + 1, dtype=np.int64)
+    small = values - 1
+    large = np.empty(r + 1, dtype=np.int64)
+    large[0] = 0
+    large[1:] = n // values[1:] - 1
+    primes_seen = 0
+    for p in range(2, r + 1):
+        sp = int(small[p - 1])
+        if small[p] == sp:
+            continue
+        primes_seen += 1
+        if progress is not None and primes_seen % LUCY_PROGRESS_STEP == 0:
+            if progress(p, 0) is False:
+                raise JobAborted()
+
+        p2 = p * p
+        lim = min(r, n // p2)
+        k = min(lim, r // p)
+        # Правая часть вычисляется целиком до присваивания, то есть по старым значениям
+        update = np.empty(lim, dtype=np.int64)
+        update[:k] = large[p:k * p + 1:p]
+        update[k:] = small[n // (values[k + 1:lim + 1] * p)]
+        update -= sp
+        large[1:lim + 1] -= update
+        if p2 <= r:
+            small[p2:] -= small[values[p2:] // p] - sp
+    return int(large[1])
+
+
+def _strong_probable_prime(n, a, d, s):
+    """Сильный тест Ферма (раунд Миллера-Рабина) по основанию a; n - 1 = d * 2^s"""
+    x = pow(a, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = x * x % n
+        if x == n - 1:
+            return True
+    return False
+
+
+def _jacobi(a, n):
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def _strong_lucas_probable_prime(n):
+    """Сильный тест Люка с параметрами Селфриджа (метод A)"""
+    root = math.isqrt(n)
+    if root * root == n:
+        return False
+
+    D = 5
+    while True:
+        j = _jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D) // 4
+
+    d = n + 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    # U_k, V_k и Q^k по двоичной записи d; деление на 2 выполняется по модулю n
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U = U * V % n
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == "1":
+            U, V = P * U + V, D * U + P * V
+            if U & 1:
+                U += n
+            U = (U >> 1) % n
+            if V & 1:
+                V += n
+            V = (V >> 1) % n
+            Qk = Qk * Q % n
+
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        if V == 0:
+            return True
+        Qk = Qk * Qk % n
+    return False
+
+
+def is_prime(n):
+    """Проверка простоты: отсев малыми делителями, затем детерминированный тест
+
+    До 2^64 - Миллер-Рабин с минимальным достаточным набором оснований,
+    выше - Baillie-PSW. Если установлен gmpy2, тесты выполняет он.
+    """
+    if n < SMALL_PRIMES_LIMIT:
+        return n in SMALL_PRIMES_SET
+    if math.gcd(n, SMALL_PRIMES_PRODUCT) != 1:
+        return False
+    # Без малых делителей число меньше квадрата границы отсева простое
+    if n < SMALL_PRIMES_LIMIT * SMALL_PRIMES_LIMIT:
+        return True
+    return strong_prime_test(n)
+
+
+def strong_prime_test(n):
+    """Детерминированный тест для нечетного n, не являющегося малым простым"""
+    if n < MR_BASES_BOUND:
+        bases = next(bases for bound, bases in MR_BASES if n < bound)
+        # Основания, сравнимые с 0 или 1 по модулю n, ничего не проверяют
+        bases = [a % n for a in bases if a % n > 1]
+        if gmpy2 is not None:
+            return all(gmpy2.is_strong_prp(n, a) for a in bases)
+        d = n - 1
+        s = (d & -d).bit_length() - 1
+        d >>= s
+        return all(_strong_probable_prime(n, a, d, s) for a in bases)
+
+    if gmpy2 is not None:
+        return gmpy2.is_strong_bpsw_prp(n)
+    d = n - 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+    return _strong_probable_prime(n, 2, d, s) and _strong_lucas_probable_prime(n)
+
+
+def count_range(start, end, batch_size, progress=None, engine="python"):
+    """Подсчет простых в диапазоне с выбором вычислительного движка
+
+    Функция модульного уровня, чтобы ее можно было отправлять в пул процессов.
+    engine="numpy" включает векторизованную проверку для чисел меньше 2^64.
+    """
+    method = range_method(start, end, engine)
+    if method == "lucy":
+        return prime_pi(end, progress) - prime_pi(start - 1, progress)
+    if method == "sieve":
+        return sieve_count(start, end, progress)
+    if method == "numpy":
+        return numpy_sparse_count(start, end, max(batch_size, NUMPY_WINDOW_MIN_SIZE), progress)
+    return sparse_count(start, end, max(batch_size, WINDOW_MIN_SIZE), progress)
+
+
+def range_method(start, end, engine="python"):
+    """Имя метода, которым count_range посчитает диапазон (для метрик)"""
+    if use_lucy(start, end):
+        return "lucy"
+    if use_sieve(start, end):
+        return "sieve"
+    if engine == "numpy" and np is not None and end < MR_BASES_BOUND:
+        return "numpy"
+    return "sparse"
+
+
+def sparse_count(start, end, window, progress=None):
+    """Подсчет простых для разреженных диапазонов большой величины
+
+    Нечетные числа окна просеиваются малыми простыми (это заменяет колесо
+    по модулю 30/210 и отсекает больше кандидатов), и строгий тест
+    запускается только для оставшихся. progress вызывается раз на окно.
+    """
+    count = 1 if start <= 2 <= end else 0
+    lo = max(start, 3) | 1
+    window += window & 1
+
+    while lo <= end:
+        hi = min(lo + window - 1, end)
+        limit = WINDOW_SIEVE_LIMIT if hi < MR_BASES_BOUND else WINDOW_SIEVE_LIMIT_LARGE
+        segment = sieve_window(lo, hi, base_primes(limit)[1:])
+
+        # Уцелевшее число меньше квадрата границы просеивания простое
+        bound = limit * limit
+        for num in compress(range(lo, hi + 1, 2), segment):
+            if num < bound or strong_prime_test(num):
+                count += 1
+
+        if progress is not None and progress(hi, count) is False:
+            raise JobAborted()  # выходим из обработки, клиент отключён
+        lo += 2 * len(segment)
+
+    return count
+
+
+def iter_primes(start, end, window=WINDOW_MIN_SIZE, progress=None):
+    """Простые из [start, end] по возрастанию, без накопления в памяти
+
+    Плотные диапазоны просеиваются полностью, в разреженных после
+    просеивания малыми простыми оставшиеся числа проверяются строгим
+    тестом. progress(num, count) вызывается раз на окно.
+    """
+    count = 0
+    if start <= 2 <= end:
+        count += 1
+        yield 2
+    lo = max(start, 3) | 1
+    dense = use_sieve(start, end)
+    if dense:
+        primes = base_primes(math.isqrt(end))[1:]
+        window = 2 * SEGMENT_BYTES
+    # Узкие окна просеиваются теми же малыми простыми, что и широкие
+    window = max(window, WINDOW_MIN_SIZE)
+    window += window & 1
+
+    while lo <= end:
+        hi = min(lo + window - 1, end)
+        if dense:
+            segment = sieve_window(lo, hi, primes)
+            for num in compress(range(lo, hi + 1, 2), segment):
+                count += 1
+                yield num
+        else:
+            limit = WINDOW_SIEVE_LIMIT if hi < MR_BASES_BOUND else WINDOW_SIEVE_LIMIT_LARGE
+            segment = sieve_window(lo, hi, base_primes(limit)[1:])
+            bound = limit * limit
+            for num in compress(range(lo, hi + 1, 2), segment):
+                if num < bound or strong_prime_test(num):
+                    count += 1
+                    yield num
+
+        if progress is not None and progress(hi, count) is False:
+            raise JobAborted()
+        lo += 2 * len(segment)
+
+
+def analyze_range(start, end, window=WINDOW_MIN_SIZE, progress=None):
+    """Количество простых [start, end] и статистика по ним за один проход
+
+    Подсчет без перечисления (pi(x), кэш, индекс) здесь не годится:
+    пары и промежутки требуют самих простых, поэтому диапазон всегда
+    просеивается тем же движком, что и при перечислении.
+    """
+    stats = RangeStats(start, end)
+    for prime in iter_primes(start, end, window, progress):
+        stats.add(prime)
+    return stats
+
+
+def _mul_wide(a, b):
+    """Полное 128-битное произведение массивов uint64: (младшие, старшие 64 бита)"""
+    a_lo, a_hi = a & UINT32_MASK, a >> UINT32_SHIFT
+    b_lo, b_hi = b & UINT32_MASK, b >> UINT32_SHIFT
+    p0 = a_lo * b_lo
+    p1 = a_lo * b_hi
+    p2 = a_hi * b_lo
+    mid = (p0 >> UINT32_SHIFT) + (p1 & UINT32_MASK) + (p2 & UINT32_MASK)
+    hi = a_hi * b_hi + (p1 >> UINT32_SHIFT) + (p2 >> UINT32_SHIFT) + (mid >> UINT32_SHIFT)
+    return a * b, hi
+
+
+def _mont_mul(a, b, n, n_prime):
+    """Умножение Монтгомери a * b / 2^64 mod n без переполнения"""
+    lo, hi = _mul_wide(a, b)
+    _, m_hi = _mul_wide(lo * n_prime, n)
+    # lo + младшая половина m * n всегда дает 0 с переносом, если lo != 0
+    t = hi + m_hi
+    t_carry = t + (lo != 0).astype(np.uint64)
+    reduce = (t < hi) | (t_carry < t) | (t_carry >= n)
+    return np.where(reduce, t_carry - n, t_carry)
+
+
+def miller_rabin_uint64(n):
+    """Векторизованный детерминированный Миллер-Рабин для нечетных n < 2^64
+
+    Возвращает булев массив. Основание проверяется только для чисел,
+    прошедших предыдущие, поэтому составные отсеиваются в основном первым.
+    """
+    one = np.uint64(1)
+    d = n - one
+    s = np.zeros(n.shape, dtype=np.uint64)
+    while True:
+        even = (d & one) == 0
+        if not even.any():
+            break
+        d = np.where(even, d >> one, d)
+        s += even
+
+    # -1/n mod 2^64 итерациями Ньютона и 2^64 mod n (единица в форме Монтгомери)
+    inverse = n.copy()
+    for _ in range(5):
+        inverse *= np.uint64(2) - n * inverse
+    n_prime = np.uint64(0) - inverse
+    one_m = (np.uint64(0) - n) % n
+    minus_one_m = n - one_m
+
+    alive = np.ones(n.shape, dtype=bool)
+    for a in MR_BASES[-1][1]:
+        idx = np.flatnonzero(alive)
+        if idx.size == 0:
+            break
+        nn, dd, ss, np_ = n[idx], d[idx], s[idx], n_prime[idx]
+        x = np.uint64(a) % nn
+        trivial = x <= one
+        # a * 2^64 mod n удвоениями
+        for _ in range(64):
+            x = np.where(x >= nn - x, x - (nn - x), x + x)
+        base = x
+        x = one_m[idx]
+        for bit in range(int(dd.max()).bit_length() - 1, -1, -1):
+            x = _mont_mul(x, x, nn, np_)
+            selected = ((dd >> np.uint64(bit)) & one) == one
+            x = np.where(selected, _mont_mul(x, base, nn, np_), x)
+        passed = (x == one_m[idx]) | (x == minus_one_m[idx]) | trivial
+        for r in range(1, int(ss.max())):
+            x = _mont_mul(x, x, nn, np_)
+            passed |= (x == minus_one_m[idx]) & (np.uint64(r) < ss)
+        alive[idx[~passed]] = False
+    return alive
+
+
+def numpy_sparse_count(start, end, window, progress=None):
+    """Векторизованный вариант sparse_count для end < 2^64"""
+    count = 1 if start <= 2 <= end else 0
+    lo = max(start, 3) | 1
+    window += window & 1
+    primes = base_primes(WINDOW_SIEVE_LIMIT)[1:]
+    bound = WINDOW_SIEVE_LIMIT * WINDOW_SIEVE_LIMIT
+
+    while lo <= end:
+        hi = min(lo + window - 1, end)
+        size = (hi - lo) // 2 + 1
+        mask = np.ones(size, dtype=bool)
+        for p in primes:
+            first = p * p
+            if first > hi:
+                break
+            if first < lo:
+                first = ((lo + p - 1) // p) * p
+                if first % 2 == 0:
+                    first += p
+            idx = (first - lo) // 2
+            mask[idx::p] = False
+
+        candidates = np.uint64(lo) + np.uint64(2) * np.flatnonzero(mask).astype(np.uint64)
+        small = candidates < np.uint64(bound)
+        count += int(small.sum())
+        rest = candidates[~small]
+        if rest.size:
+            count += int(miller_rabin_uint64(rest).sum())
+
+        if progress is not None and progress(hi, count) is False:
+            raise JobAborted()
+        lo += 2 * size
+
+    return count
+
+
+class BlockCache:
+    """LRU-кэш количества простых в выровненных блоках CACHE_BLOCK_SIZE"""
+
+    def __init__(self, max_bytes, block_size=CACHE_BLOCK_SIZE):
+        self.block_size = block_size
+        self.max_entries = max(1, max_bytes // CACHE_ENTRY_BYTES)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, block):
+        with self.lock:
+            count = self.entries.get(block)
+            if count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(block)
+            return count
+
+    def put(self, block, count):
+        with self.lock:
+            self.entries[block] = count
+            self.entries.move_to_end(block)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def plan(self, start, end, cancelled=None):
+        """Разбиение диапазона на найденное в кэше и части для расчета
+
+        Возвращает (количество из кэша, [(начало, конец, блок или None)]).
+        Неполные края диапазона считаются без кэширования. Диапазон из
+        большего числа блоков, чем вмещает кэш, не разбивается: его блоки
+        вытеснили бы друг друга раньше, чем пригодились. Если cancelled()
+        становится истинным, разбиение прерывается исключением JobAborted.
+        """
+        size = self.block_size
+        first_block = -(-start // size)
+        last_block = (end + 1) // size - 1
+        if first_block > last_block or last_block - first_block >= self.max_entries:
+            return 0, [(start, end, None)]
+
+        cached = 0
+        pieces = []
+        if start < first_block * size:
+            pieces.append((start, first_block * size - 1, None))
+        for block in range(first_block, last_block + 1):
+            if (cancelled is not None and (block - first_block) % CACHE_PLAN_CHECK_STEP == 0
+                    and cancelled()):
+                raise JobAborted()
+            count = self.get(block)
+            if count is None:
+                pieces.append((block * size, (block + 1) * size - 1, block))
+            else:
+                cached += count
+        if end >= (last_block + 1) * size:
+            pieces.append(((last_block + 1) * size, end, None))
+        return cached, pieces
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_ratio': self.hits / total if total else 0.0,
+                'cache_blocks': len(self.entries),
+            }
+
+
+class PrimeIndex:
+    """Индекс на диске: количество простых меньше k * step для каждого k
+
+    Файл - заголовок INDEX_HEADER и массив uint64, открытый через mmap,
+    поэтому загрузка не зависит от размера индекса.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.step, entries = INDEX_HEADER.unpack_from(self.mmap)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path}: неподдерживаемый формат индекса")
+        self.counts = memoryview(self.mmap)[INDEX_HEADER.size:].cast("Q")[:entries]
+        # Индекс знает pi(x) для x < bound
+        self.bound = (entries - 1) * self.step
+
+    def plan(self, start, end):
+        """Количество простых, известное из индекса, и края для расчета"""
+        step = self.step
+        first = -(-start // step)
+        last = min((end + 1) // step, len(self.counts) - 1)
+        if last - first < 1:
+            return 0, [(start, end)]
+
+        pieces = []
+        if start < first * step:
+            pieces.append((start, first * step - 1))
+        if end >= last * step:
+            pieces.append((last * step, end))
+        return self.counts[last] - self.counts[first], pieces
+
+    def close(self):
+        self.counts.release()
+        self.mmap.close()
+
+
+def build_index(path, limit, step=INDEX_STEP, executor=None):
+    """Построение или дополнение индекса pi(x) до limit тем же движком подсчета"""
+    counts = [0]
+    if os.path.exists(path):
+        index = PrimeIndex(path)
+        if index.step != step:
+            raise ValueError(f"{path}: шаг индекса {index.step}, а не {step}")
+        counts = list(index.counts)
+        index.close()
+
+    blocks = range(len(counts) - 1, -(-limit // step))
+    if executor is not None:
+        results = executor.map(count_range, [k * step for k in blocks],
+                               [(k + 1) * step - 1 for k in blocks],
+                               [step] * len(blocks), chunksize=16)
+    else:
+        results = (count_range(k * step, (k + 1) * step - 1, step) for k in blocks)
+
+    report_every = max(1, len(blocks) // 100)
+    for n, block_count in enumerate(results, 1):
+        counts.append(counts[-1] + block_count)
+        if n % report_every == 0:
+            print(f"[{datetime.now()}] Index: {n}/{len(blocks)} blocks, "
+                  f"pi({(len(counts) - 1) * step}) = {counts[-1]}")
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, step, len(counts)))
+        f.write(array.array("Q", counts).tobytes())
+    os.replace(tmp_path, path)
+    return (len(counts) - 1) * step
+
+
+class Job:
+    """Выполняемый запрос; отмена видна и потокам, и процессам пула"""
+
+    def __init__(self, request_id, profile=None, reply_profile=False, stream=False,
+                 analytics=False):
+        self.request_id = request_id
+        self.stream = stream
+        self.analytics = analytics
+        self.received = time.monotonic()
+        self.profile = profile
+        self.reply_profile = reply_profile
+        self.event = threading.Event()
+        self.flags = None
+        self.slot = None
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+        if self.slot is not None:
+            self.flags[self.slot] = 1
+
+    def attach(self, flags, slot):
+        """Привязка к ячейке флага отмены в общей памяти"""
+        self.flags = flags
+        self.slot = slot
+        flags[slot] = 1 if self.cancelled else 0
+
+    def detach(self):
+        slot, self.slot = self.slot, None
+        return slot
+
+
+class ClientConnection:
+    """Сокет клиента с блокировкой записи: ответы на запросы идут из разных потоков"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active_jobs = 0
+
+    def sendall(self, data, profile=None):
+        with locked(profile, self.send_lock, "send_lock_wait"):
+            self.sock.sendall(data)
+
+
+class AsyncClientConnection:
+    """Соединение asyncio: запись из потоков расчета передается в цикл событий"""
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active_jobs = 0
+        self.closed = False
+        # Соединение создается в потоке цикла событий
+        self.loop_thread = threading.get_ident()
+
+    def sendall(self, data, profile=None):
+        if self.closed:
+            raise ConnectionResetError("Клиент отключился")
+        if threading.get_ident() == self.loop_thread:
+            # Ответы из dispatch (статус, отказы, ошибки): ждать здесь нельзя,
+            # цикл ждал бы сам себя; заполненный буфер приостанавливает чтение
+            # запросов этого соединения в handle_client_async
+            self.writer.write(data)
+            return
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        # Медленный клиент потокового ответа: ждем, пока буфер записи опустеет,
+        # иначе кадры копились бы в памяти сервера
+        if self.writer.transport.get_write_buffer_size() > ASYNC_WRITE_LIMIT:
+            asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop).result(IDLE_TIMEOUT)
+
+
+def peer_host(addr):
+    """Адрес клиента без порта: по нему считаются задачи клиента"""
+    return addr[0] if isinstance(addr, tuple) else addr
+
 
 class PrimeServer:
-    def __init__(self):
+    def __init__(self, backend="thread", cache_bytes=0, index_path=None, engine="python",
+                 profile_dir=None, max_queue=None, max_client_jobs=MAX_CLIENT_JOBS,
+                 max_connections=MAX_CONNECTIONS):
+        self.backend = backend
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.engine = engine
+        self.engine_speedup = None
+        self.cache = BlockCache(cache_bytes) if cache_bytes > 0 else None
+        self.index = PrimeIndex(index_path) if index_path else None
+        self.job_executor = None
+        self.compute_pool = None
+        self.compute_workers = os.cpu_count() or 1
+        self.max_workers = None
+        # None - QUEUE_PER_WORKER задач на рабочий поток, 0 - без ограничения
+        self.max_queue = max_queue
+        self.max_client_jobs = max_client_jobs
+        self.max_connections = max_connections
+        self.working_connections = 0
+        self.client_jobs = Counter()
+        self.cancel_flags = None
+        self.free_slots = []
         self.active_connections = 0
         self.total_processed = 0
         self.lock = threading.Lock()
         self.start_time = time.time()
+        self.metrics = Metrics()
     
     def is_prime(self, n):
-        """Оптимизированная проверка простоты с использованием теста Миллера-Рабина"""
-        if n <= 1:
-            return False
-        elif n <= 3:
+        """Детерминированная проверка простоты (Миллер-Рабин до 2^64, выше Baillie-PSW)"""
+        return is_prime(n)
+
+    def send_status(self, conn, num, count, request_id=0, profile=None):
+        """Отправка промежуточного статуса клиенту"""
+        try:
+            conn.sendall(protocol.progress_frame(num, count, request_id), profile)
             return True
-        elif n % 2 == 0 or n % 3 == 0:
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            print(f"[{datetime.now()}] Ошибка отправки STATUS: {e}")
             return False
-        
-        # Тест Миллера-Рабина для больших чисел
-        d = n - 1
-        s = 0
-        while d % 2 == 0:
-            d //= 2
-            s += 1
-        
-        for a in [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]:
-            if a >= n:
-                continue
-            x = pow(a, d, n)
-            if x == 1 or x == n - 1:
-                continue
-            for _ in range(s - 1):
-                x = pow(x, 2, n)
-                if x == n - 1:
-                    break
-            else:
+
+    def progress_sender(self, conn, request_id=0, job=None):
+        """Отправка статуса не чаще PROGRESS_INTERVAL секунд и проверка отмены задачи"""
+        last_sent = [time.monotonic()]
+        profile = job.profile if job is not None else None
+
+        def send(num, count):
+            if job is not None and job.cancelled:
                 return False
-        return True
+            if conn is None:
+                return True
+            now = time.monotonic()
+            if now - last_sent[0] < PROGRESS_INTERVAL:
+                return True
+            last_sent[0] = now
+            with phase(profile, "send"):
+                return self.send_status(conn, num, count, request_id, profile)
+
+        return send
 
-    def process_range(self, start, end, batch_size, conn=None):
+    def process_range(self, start, end, batch_size, conn=None, request_id=0, job=None):
         """Обработка диапазона чисел с отправкой статуса"""
+        progress = None
+        if conn is not None or job is not None:
+            progress = self.progress_sender(conn, request_id, job)
+        profile = job.profile if job is not None else None
+        with phase(profile, "plan"):
+            count, pieces = self.plan_range(start, end, job)
+
+        if self.compute_pool is not None:
+            count = self.process_range_parallel(pieces, batch_size, progress, count, job)
+        else:
+            for piece_start, piece_end, block in pieces:
+                piece_progress = None
+                if progress is not None:
+                    piece_progress = lambda num, c, base=count: progress(num, base + c)
+                began = time.perf_counter()
+                with phase(profile, "compute"):
+                    piece_count = count_range(piece_start, piece_end, batch_size,
+                                              piece_progress, self.engine)
+                self.metrics.record_engine(range_method(piece_start, piece_end, self.engine),
+                                           time.perf_counter() - began,
+                                           piece_end - piece_start + 1)
+                if block is not None:
+                    self.cache.put(block, piece_count)
+                count += piece_count
+
+        with locked(profile, self.lock):
+            self.total_processed += (end - start + 1)
+        return count
+
+    def stream_primes(self, start, end, batch_size, conn, request_id=0, job=None):
+        """Отправка простых диапазона кадрами PRIMES по мере нахождения
+
+        В памяти держится не больше одного кадра; возвращает число простых.
+        """
+        profile = job.profile if job is not None else None
+        progress = self.progress_sender(conn, request_id, job)
         count = 0
-        current = start
-        
-        while current <= end:
-            batch_end = min(current + batch_size - 1, end)
-            
-            if current <= 2 <= batch_end:
-                count += 1
-            
-            num = current if current % 2 != 0 else current + 1
-            if num > batch_end:
-                break
-                
-            for num in range(num, batch_end + 1, 2):
-                if self.is_prime(num):
-                    count += 1
-                
-                if num % 500 == 1 and conn:
-                    try:
-                        conn.sendall(f"STATUS:{num}:{count}".encode())
-                    except (ConnectionResetError, BrokenPipeError, OSError) as e:
-                        print(f"[{datetime.now()}] Ошибка отправки STATUS: {e}")
-                        break  # выходим из обработки, клиент отключён
-            
-            current = batch_end + 1
-        
-        with self.lock:
+        buffer = []
+
+        def flush():
+            try:
+                with phase(profile, "send"):
+                    conn.sendall(protocol.primes_frame(buffer, request_id), profile)
+            except OSError:
+                raise JobAborted()  # клиент отключился посреди потока
+
+        with phase(profile, "compute"):
+            for prime in iter_primes(start, end, batch_size, progress):
+                buffer.append(prime)
+                if len(buffer) >= PRIMES_PER_FRAME:
+                    flush()
+                    count += len(buffer)
+                    buffer = []
+            if buffer:
+                flush()
+                count += len(buffer)
+
+        with locked(profile, self.lock):
             self.total_processed += (end - start + 1)
         return count
 
+    def analyze(self, start, end, batch_size, conn=None, request_id=0, job=None):
+        """Статистика простых диапазона; в пуле процессов - по частям со склейкой"""
+        progress = None
+        if conn is not None or job is not None:
+            progress = self.progress_sender(conn, request_id, job)
+        profile = job.profile if job is not None else None
+
+        if self.compute_pool is not None:
+            stats = self.analyze_parallel(start, end, batch_size, progress, job)
+        else:
+            began = time.perf_counter()
+            with phase(profile, "compute"):
+                stats = analyze_range(start, end, batch_size, progress)
+            self.metrics.record_engine("analytics", time.perf_counter() - began,
+                                       end - start + 1)
+
+        with locked(profile, self.lock):
+            self.total_processed += (end - start + 1)
+        return stats
+
+    def analyze_parallel(self, start, end, batch_size, progress=None, job=None):
+        """Статистика частей диапазона в пуле процессов, склеенная по порядку"""
+        profile = job.profile if job is not None else None
+        target = (end - start + 1) // (self.compute_workers * PROCESS_CHUNKS_PER_WORKER)
+        began = time.perf_counter()
+        parts = {}
+        count = 0
+        with self.pool_tasks(job) as (slot, futures):
+            for r_start, r_end in self.split_piece(start, end, target):
+                future = self.compute_pool.submit(analyze_range_task, r_start, r_end,
+                                                  batch_size, slot)
+                futures[future] = r_start
+            with phase(profile, "compute"):
+                for future in as_completed(futures):
+                    part = future.result()
+                    parts[futures[future]] = part
+                    count += part.count
+                    if progress is not None and not progress(part.end, count):
+                        raise JobAborted()
+        self.metrics.record_engine("analytics", time.perf_counter() - began, end - start + 1)
+
+        stats = RangeStats(start, start - 1)
+        for r_start in sorted(parts):
+            stats = stats.merge(parts[r_start])
+        return stats
+
+    def plan_range(self, start, end, job=None):
+        """Уже известное количество простых (индекс, кэш) и части для расчета"""
+        cancelled = (lambda: job.cancelled) if job is not None else None
+        known, ranges = 0, [(start, end)]
+        if self.index is not None:
+            known, ranges = self.index.plan(start, end)
+
+        pieces = []
+        for range_start, range_end in ranges:
+            # Сублинейный подсчет дешевле любого разбиения на блоки
+            if self.cache is not None and not use_lucy(range_start, range_end):
+                cached, cache_pieces = self.cache.plan(range_start, range_end, cancelled)
+                known += cached
+                pieces.extend(cache_pieces)
+            else:
+                pieces.append((range_start, range_end, None))
+        return known, pieces
+
+    def split_for_pool(self, pieces):
+        """Нарезка частей диапазона на подзадачи для пула процессов"""
+        total = sum(piece_end - piece_start + 1 for piece_start, piece_end, _ in pieces)
+        target = total // (self.compute_workers * PROCESS_CHUNKS_PER_WORKER)
+        for index, (piece_start, piece_end, _) in enumerate(pieces):
+            if use_lucy(piece_start, piece_end):
+                yield index, (piece_start, piece_end)
+                continue
+            for sub_range in self.split_piece(piece_start, piece_end, target):
+                yield index, sub_range
+
+    def split_piece(self, start, end, target):
+        """Подзадачи шириной около target, но не уже, чем выгодно движку"""
+        if use_sieve(start, end):
+            min_chunk = SIEVE_DENSITY * math.isqrt(end)
+        else:
+            min_chunk = PROCESS_MIN_CHUNK
+        chunks = max(1, (end - start + 1) // max(target, min_chunk))
+        return self.distribute_range(start, end, chunks)
+
+    @contextmanager
+    def pool_tasks(self, job=None):
+        """Ячейка флага отмены задачи и словарь ее подзадач в пуле процессов
+
+        Возвращает (ячейка или None, futures); вызывающий добавляет
+        в futures отправленные подзадачи. На выходе неначатые подзадачи
+        отменяются, а ячейка освобождается только после остановки начатых.
+        """
+        slot = None
+        profile = job.profile if job is not None else None
+        if job is not None and self.cancel_flags is not None:
+            with locked(profile, self.lock):
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                    job.attach(self.cancel_flags, slot)
+        futures = {}
+        try:
+            yield slot, futures
+        finally:
+            for future in futures:
+                future.cancel()
+            if slot is not None:
+                # Ячейку можно отдать другой задаче только после остановки своих частей
+                job.cancel()
+                wait(futures)
+                with locked(profile, self.lock):
+                    self.free_slots.append(job.detach())
+
+    def process_range_parallel(self, pieces, batch_size, progress=None, count=0, job=None):
+        """Обработка частей диапазона в пуле процессов с суммированием частичных результатов"""
+        profile = job.profile if job is not None else None
+        with self.pool_tasks(job) as (slot, futures):
+            for index, (r_start, r_end) in self.split_for_pool(pieces):
+                future = self.compute_pool.submit(timed_range_task, r_start, r_end, batch_size,
+                                                  slot, self.engine)
+                futures[future] = (index, r_start, r_end)
+            remaining = Counter(index for index, _, _ in futures.values())
+            piece_counts = [0] * len(pieces)
+            # Время ожидания частей; счет в процессах пула - отдельно, в pool_compute
+            with phase(profile, "compute"):
+                for future in as_completed(futures):
+                    index, r_start, r_end = futures[future]
+                    partial_count, elapsed = future.result()
+                    if profile is not None:
+                        profile.add("pool_compute", elapsed)
+                    self.metrics.record_engine(range_method(r_start, r_end, self.engine),
+                                               elapsed, r_end - r_start + 1)
+                    count += partial_count
+                    piece_counts[index] += partial_count
+                    remaining[index] -= 1
+                    block = pieces[index][2]
+                    if remaining[index] == 0 and block is not None:
+                        self.cache.put(block, piece_counts[index])
+                    if progress is not None and not progress(pieces[index][1], count):
+                        raise JobAborted()  # клиент отключён, оставшиеся части не нужны
+        return count
+
+    def get_stats(self):
+        stats = {
+            'active_connections': self.active_connections,
+            'total_processed': self.total_processed,
+            'uptime': time.time() - self.start_time,
+            'cpu_load': psutil.cpu_percent(),
+            'memory_usage': psutil.virtual_memory().percent
+        }
+        if self.max_workers is not None:
+            stats['workers'] = self.max_workers
+            stats['max_queue'] = self.max_queue
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        if self.index is not None:
+            stats['index_bound'] = self.index.bound
+        stats['engine'] = self.engine
+        if self.engine_speedup is not None:
+            stats['engine_speedup'] = self.engine_speedup
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def calibrate_engine(self, start=ENGINE_CALIBRATION_START, width=NUMPY_WINDOW_MIN_SIZE):
+        """Замер ускорения векторизованного движка относительно обычного на пробном окне"""
+        began = time.perf_counter()
+        sparse_count(start, start + width - 1, WINDOW_MIN_SIZE)
+        python_time = time.perf_counter() - began
+        began = time.perf_counter()
+        numpy_sparse_count(start, start + width - 1, width)
+        numpy_time = time.perf_counter() - began
+        self.engine_speedup = round(python_time / numpy_time, 2)
+        print(f"[{datetime.now()}] Engine {self.engine}: {self.engine_speedup}x "
+              f"vs python on numbers near {start}")
+
     def handle_client(self, conn, addr):
+        """Обслуживание постоянного соединения: запросы читаются, пока клиент не отключится"""
         try:
             with self.lock:
                 self.active_connections += 1
             
-            conn.settimeout(300)
-            data = conn.recv(1024).decode().strip()
+            conn.settimeout(IDLE_TIMEOUT)
+            client = ClientConnection(conn)
+            reader = protocol.FrameReader(conn)
             
-            if not data:
-                return
-                
-            if data == "status":
-                stats = {
-                    'active_connections': self.active_connections,
-                    'total_processed': self.total_processed,
-                    'uptime': time.time() - self.start_time,
-                    'cpu_load': psutil.cpu_percent(),
-                    'memory_usage': psutil.virtual_memory().percent
-                }
-                conn.sendall(str(stats).encode())
-                return
-                
-            parts = data.split(',')
-            if len(parts) != 3:
-                conn.sendall(b"Invalid request format")
-                return
+            while True:
+                try:
+                    frame = reader.read_frame()
+                except socket.timeout:
+                    if client.jobs:
+                        continue
+                    break  # соединение простаивает слишком долго
                 
-            start, end, batch_size = map(int, parts)
+                if frame is None:
+                    break
+                self.dispatch(client, addr, *frame)
             
+        except Exception as e:
+            print(f"[{datetime.now()}] Error with {addr}: {str(e)}")
+            try:
+                conn.sendall(protocol.error_frame("Server error"))
+            except:
+                pass
+        finally:
+            self.cancel_jobs(client)
+            with self.lock:
+                self.active_connections -= 1
+            try:
+                conn.close()
+            except:
+                pass
+
+    def admit(self, client, addr):
+        """Прием новой задачи; при перегрузке - причина отказа
+
+        Задачи клиента считаются по его адресу, а не по соединению: пул
+        клиента держит несколько соединений. Соединение занимает место,
+        только пока у него есть задачи, поэтому простаивающие соединения
+        пулов и опрос статуса места не тратят.
+        """
+        host = peer_host(addr)
+        with self.lock:
+            if self.max_client_jobs and self.client_jobs[host] >= self.max_client_jobs:
+                return "too many jobs from client"
+            if (not client.active_jobs and self.max_connections
+                    and self.working_connections >= self.max_connections):
+                return "too many connections"
+            if not self.metrics.job_queued(self.max_queue):
+                return "job queue is full"
+            if not client.active_jobs:
+                self.working_connections += 1
+            client.active_jobs += 1
+            self.client_jobs[host] += 1
+        return None
+
+    def release(self, client, addr):
+        """Задача завершена: освобождение ее места у клиента и соединения"""
+        host = peer_host(addr)
+        with self.lock:
+            client.active_jobs -= 1
+            if not client.active_jobs:
+                self.working_connections -= 1
+            self.client_jobs[host] -= 1
+            if not self.client_jobs[host]:
+                del self.client_jobs[host]
+
+    def retry_after(self):
+        """Через сколько секунд повторить отклоненный запрос: время разбора очереди"""
+        workers = self.max_workers or 1
+        queued = self.metrics.queued
+        estimate = self.metrics.mean_job_seconds() * (queued + 1) / workers
+        return min(RETRY_AFTER_MAX, max(RETRY_AFTER_MIN, estimate))
+
+    def dispatch(self, client, addr, frame_type, request_id, payload):
+        """Разбор одного кадра: статус отвечается сразу, расчеты идут в пул"""
+        if frame_type == protocol.STATS:
+            client.sendall(protocol.stats_frame(self.get_stats(), request_id))
+            return
+        
+        if frame_type == protocol.CANCEL:
+            with client.lock:
+                job = client.jobs.get(request_id)
+            if job is not None:
+                job.cancel()
+                print(f"[{datetime.now()}] {addr} cancelled job {request_id}")
+            return
+            
+        if frame_type not in (protocol.REQUEST, protocol.PROFILE, protocol.ENUMERATE,
+                              protocol.ANALYZE):
+            client.sendall(protocol.error_frame("Invalid request format", request_id))
+            return
+        
+        parts = protocol.decode_ints(payload)
+        if len(parts) != 3:
+            client.sendall(protocol.error_frame("Invalid request format", request_id))
+            return
+        
+        reason = self.admit(client, addr)
+        if reason is not None:
+            self.metrics.job_rejected()
+            retry_after = self.retry_after()
+            print(f"[{datetime.now()}] {addr} job {request_id} rejected: {reason}, "
+                  f"retry after {retry_after:.1f}s")
+            client.sendall(protocol.busy_frame(retry_after, request_id))
+            return
+        
+        # Профиль снимается по запросу клиента (кадр PROFILE) или для всех задач с --profile-dir
+        profile = None
+        if frame_type == protocol.PROFILE or self.profile_dir is not None:
+            profile = JobProfile()
+        job = Job(request_id, profile, reply_profile=frame_type == protocol.PROFILE,
+                  stream=frame_type == protocol.ENUMERATE,
+                  analytics=frame_type == protocol.ANALYZE)
+        with client.lock:
+            client.jobs[request_id] = job
+        self.job_executor.submit(self.run_job, client, addr, job, *parts)
+
+    def cancel_jobs(self, client):
+        """Отмена всех задач соединения, например после отключения клиента"""
+        with client.lock:
+            jobs = list(client.jobs.values())
+        for job in jobs:
+            job.cancel()
+
+    def run_job(self, client, addr, job, start, end, batch_size):
+        """Расчет одного запроса и отправка результата с его идентификатором"""
+        request_id = job.request_id
+        self.metrics.job_started()
+        outcome, numbers, count = 'failed', 0, 0
+        if job.profile is not None:
+            job.profile.add("queue", time.monotonic() - job.received)
+            job.profile.start()
+        try:
+            if job.cancelled:
+                raise JobAborted()
             print(f"[{datetime.now()}] {addr} processing {start}-{end} (batch {batch_size})")
             
             # Обработка диапазона с отправкой промежуточных результатов
-            count = self.process_range(start, end, batch_size, conn)
+            analytics = None
+            if job.stream:
+                count = self.stream_primes(start, end, batch_size, client, request_id, job)
+            elif job.analytics:
+                stats = self.analyze(start, end, batch_size, client, request_id, job)
+                count, analytics = stats.count, stats.to_ints()
+            else:
+                count = self.process_range(start, end, batch_size, client, request_id, job)
+            if job.profile is not None:
+                # Профиль уходит до результата: после RESULT клиент перестает ждать кадры
+                self.finish_profile(client, job, start, end, 'completed')
             
             try:
-                conn.sendall(str(count).encode())
-                conn.sendall(b"END")
+                client.sendall(protocol.result_frame(count, request_id, analytics))
             except Exception as e:
                 print(f"[{datetime.now()}] Ошибка при отправке результата: {e}")
 
             print(f"[{datetime.now()}] {addr} completed: {count} primes found")
-            
+            outcome, numbers = 'completed', end - start + 1
+        except JobAborted:
+            outcome = 'aborted'
+            print(f"[{datetime.now()}] {addr} job {request_id} aborted")
         except Exception as e:
             print(f"[{datetime.now()}] Error with {addr}: {str(e)}")
             try:
-                conn.sendall(b"Server error")
+                client.sendall(protocol.error_frame("Server error", request_id))
             except:
                 pass
         finally:
-            with self.lock:
-                self.active_connections -= 1
-            try:
-                conn.close()
-            except:
-                pass
+            with client.lock:
+                client.jobs.pop(request_id, None)
+            self.release(client, addr)
+            if job.profile is not None and outcome != 'completed':
+                self.finish_profile(client, job, start, end, outcome)
+            self.metrics.job_finished(outcome, time.monotonic() - job.received, numbers, count)
 
+    def finish_profile(self, client, job, start, end, outcome):
+        """Остановка профиля задачи, запись на диск и отправка клиенту"""
+        profile = job.profile
+        profile.stop()
+        report = profile.report(request_id=job.request_id, start=start, end=end,
+                                outcome=outcome, backend=self.backend, engine=self.engine)
+        if self.profile_dir is not None:
+            path = os.path.join(self.profile_dir,
+                                f"job-{datetime.now():%Y%m%d-%H%M%S}-{job.request_id}")
+            try:
+                profile.dump(path, report)
+                print(f"[{datetime.now()}] Profile of job {job.request_id} saved to {path}.json")
+            except OSError as e:
+                print(f"[{datetime.now()}] Ошибка записи профиля: {e}")
+        if job.reply_profile and outcome == 'completed':
+            try:
+                client.sendall(protocol.profile_report_frame(report, job.request_id))
+            except OSError as e:
+                print(f"[{datetime.now()}] Ошибка при отправке профиля: {e}")
 
     def distribute_range(self, start, end, chunks):
         """Распределение диапазона на части"""
@@ -143,6 +1406,33 @@ class PrimeServer:
             for i in range(chunks)
         ]
 
+    def start_pools(self, max_workers):
+        """Создание пулов для расчетов"""
+        self.max_workers = max_workers
+        if self.max_queue is None:
+            self.max_queue = QUEUE_PER_WORKER * max_workers
+        print(f"[{datetime.now()}] Max workers: {max_workers}")
+        print(f"[{datetime.now()}] Queue limit: {self.max_queue or 'none'}, "
+              f"per client: {self.max_client_jobs}, connections: {self.max_connections}")
+        print(f"[{datetime.now()}] Server PID: {os.getpid()}")
+        if self.engine == "numpy":
+            self.calibrate_engine()
+        
+        if self.backend == "process":
+            self.cancel_flags = multiprocessing.Array('b', CANCEL_SLOTS, lock=False)
+            self.free_slots = list(range(CANCEL_SLOTS))
+            self.compute_pool = ProcessPoolExecutor(max_workers=self.compute_workers,
+                                                    initializer=init_worker,
+                                                    initargs=(self.cancel_flags,))
+            print(f"[{datetime.now()}] Compute processes: {self.compute_workers}")
+        
+        self.job_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def stop_pools(self):
+        self.job_executor.shutdown(wait=False, cancel_futures=True)
+        if self.compute_pool is not None:
+            self.compute_pool.shutdown(cancel_futures=True)
+
     def start_server(self, host='0.0.0.0', port=5555, max_workers=20):
         """Запуск сервера с мониторингом"""
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -151,32 +1441,136 @@ class PrimeServer:
             s.listen()
             
             print(f"[{datetime.now()}] Server started on {host}:{port}")
-            print(f"[{datetime.now()}] Max workers: {max_workers}")
-            print(f"[{datetime.now()}] Server PID: {os.getpid()}")
+            self.start_pools(max_workers)
             
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
                 while True:
                     try:
                         conn, addr = s.accept()
                         print(f"[{datetime.now()}] New connection: {addr} "
                               f"(Active: {self.active_connections})")
-                        executor.submit(self.handle_client, conn, addr)
+                        threading.Thread(target=self.handle_client, args=(conn, addr),
+                                         daemon=True).start()
                     except Exception as e:
                         print(f"[{datetime.now()}] Connection error: {str(e)}")
+            finally:
+                self.stop_pools()
+
+    async def handle_client_async(self, reader, writer):
+        """Обслуживание соединения в цикле событий: поток не занимается на время ожидания"""
+        addr = writer.get_extra_info('peername')
+        client = AsyncClientConnection(writer, asyncio.get_running_loop())
+        frames = protocol.FrameReader()
+        try:
+            with self.lock:
+                self.active_connections += 1
+            
+            while True:
+                frame = frames.parse()
+                if frame is not None:
+                    self.dispatch(client, addr, *frame)
+                    # Клиент не читает ответы: новые запросы не разбираются, пока
+                    # буфер записи не освободится; другие соединения это не задерживает
+                    if writer.transport.get_write_buffer_size() > ASYNC_WRITE_LIMIT:
+                        await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+                    continue
+                
+                try:
+                    data = await asyncio.wait_for(reader.read(protocol.RECV_SIZE), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if client.jobs:
+                        continue
+                    break  # соединение простаивает слишком долго
+                if not data:
+                    break
+                frames.feed(data)
+            
+        except Exception as e:
+            print(f"[{datetime.now()}] Error with {addr}: {str(e)}")
+            try:
+                client.sendall(protocol.error_frame("Server error"))
+            except:
+                pass
+        finally:
+            client.closed = True
+            self.cancel_jobs(client)
+            with self.lock:
+                self.active_connections -= 1
+            try:
+                writer.close()
+            except:
+                pass
+
+    async def start_server_async(self, host='0.0.0.0', port=5555, max_workers=20):
+        """Запуск сервера на asyncio: прием и чтение без блокировки потоков"""
+        server = await asyncio.start_server(self.handle_client_async, host, port,
+                                            reuse_address=True)
+        print(f"[{datetime.now()}] Server started on {host}:{port} (asyncio)")
+        self.start_pools(max_workers)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stop_pools()
 
 if __name__ == "__main__":
-    import os
-    
     parser = argparse.ArgumentParser(description='Оптимизированный сервер для поиска простых чисел')
     parser.add_argument('--host', default='0.0.0.0', help='Server host')
     parser.add_argument('--port', type=int, default=5555, help='Server port')
     parser.add_argument('--workers', type=int, default=20, help='Worker threads')
+    parser.add_argument('--backend', choices=['thread', 'process'], default='thread',
+                        help='Compute backend: threads or process pool (one process per CPU)')
+    parser.add_argument('--engine', choices=['python', 'numpy'], default='python',
+                        help='Primality engine for sparse ranges below 2^64')
+    parser.add_argument('--cache-mb', type=int, default=64,
+                        help='Memory cap for the block result cache in MB (0 disables it)')
+    parser.add_argument('--index', help='Path to the on-disk pi(x) index')
+    parser.add_argument('--build-index', type=int, metavar='LIMIT',
+                        help='Build or extend the --index file up to LIMIT and exit')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve /metrics (Prometheus) and /metrics.json over HTTP on this port')
+    parser.add_argument('--profile-dir',
+                        help='Profile every job and write the reports to this directory')
+    parser.add_argument('--max-queue', type=int,
+                        help=f'Jobs waiting for a worker before new ones are rejected '
+                             f'(default {QUEUE_PER_WORKER} per worker, 0 - unlimited)')
+    parser.add_argument('--max-client-jobs', type=int, default=MAX_CLIENT_JOBS,
+                        help='Jobs one client address may have queued or running (0 - unlimited)')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='Connections with jobs; status requests are always answered '
+                             '(0 - unlimited)')
+    parser.add_argument('--frontend', choices=['thread', 'asyncio'], default='thread',
+                        help='Connection handling: thread per connection or asyncio event loop')
     
     args = parser.parse_args()
+    if args.engine == 'numpy' and np is None:
+        parser.error('--engine numpy requires numpy to be installed')
+    
+    if args.build_index is not None:
+        if not args.index:
+            parser.error('--build-index requires --index PATH')
+        if args.backend == 'process':
+            with ProcessPoolExecutor() as pool:
+                bound = build_index(args.index, args.build_index, executor=pool)
+        else:
+            bound = build_index(args.index, args.build_index)
+        print(f"[{datetime.now()}] Index {args.index} covers numbers below {bound}")
+        raise SystemExit(0)
     
-    server = PrimeServer()
+    server = PrimeServer(backend=args.backend, cache_bytes=args.cache_mb * 1024 * 1024,
+                         index_path=args.index, engine=args.engine,
+                         profile_dir=args.profile_dir, max_queue=args.max_queue,
+                         max_client_jobs=args.max_client_jobs,
+                         max_connections=args.max_connections)
+    if args.metrics_port is not None:
+        serve_metrics(server.get_stats, args.host, args.metrics_port)
+        print(f"[{datetime.now()}] Metrics on http://{args.host}:{args.metrics_port}/metrics")
     try:
-        server.start_server(host=args.host, port=args.port, max_workers=args.workers)
+        if args.frontend == 'asyncio':
+            asyncio.run(server.start_server_async(host=args.host, port=args.port,
+                                                  max_workers=args.workers))
+        else:
+            server.start_server(host=args.host, port=args.port, max_workers=args.workers)
     except KeyboardInterrupt:
         print(f"[{datetime.now()}] Server stopped")
     except Exception as e: